@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 from importlib import import_module
 import os
-from flask import Flask, render_template, Response, send_from_directory
+import time
+from flask import Flask, render_template, Response, send_from_directory, request, jsonify
 from flask_cors import *
 # import camera driver
 #import camera_opencv
 from camera_opencv import Camera
 from camera_opencv import commandAct
+from stream_profile import get_profile
+import stream_flow
+import pipeline_stats
+import clip_recorder
+import robot
 import threading
 
 # Raspberry Pi camera module (requires picamera package)
@@ -16,19 +22,73 @@ app = Flask(__name__)
 CORS(app, supports_credentials=True)
 camera = Camera()
 
-def gen(camera):
+def gen(camera, profile, remote=None):
     """Video streaming generator function."""
-    while True:
-        frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    flow = stream_flow.ClientFlow(profile, remote)
+    stream_flow.register(flow)
+    subscribed = flow.profile
+    camera.subscribe(subscribed)
+    try:
+        # the broadcast outlives its viewers; start after its current frame,
+        # which may be from a camera that has been stopped since
+        seq = Camera.broadcasts[subscribed].latest.seq
+        while True:
+            frame = camera.wait_frame(seq, profile=subscribed)
+            seq = frame.seq
+            if not flow.should_send(time.time()):
+                continue
+            # the generator is resumed once the chunk has been written, so
+            # this measures how fast the client drains its socket
+            written = time.time()
+            pipeline_stats.record('delivery', written - frame.timestamp, Camera.modeSelect)
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame.data + b'\r\n')
+            flow.record_write(time.time() - written, frame.seq)
+            if flow.profile != subscribed:
+                camera.subscribe(flow.profile)
+                camera.unsubscribe(subscribed)
+                subscribed = flow.profile
+    finally:
+        # runs when the client disconnects and the generator is closed
+        camera.unsubscribe(subscribed)
+        stream_flow.unregister(flow)
 
 @app.route('/video_feed')
 def video_feed():
-    """Video streaming route. Put this in the src attribute of an img tag."""
-    return Response(gen(camera),
+    """Video streaming route. Put this in the src attribute of an img tag.
+
+    Optional query parameters: profile=full|half|thumbnail, quality=10..95 and
+    overlay=0 for frames without the CV annotations.
+    """
+    try:
+        profile = get_profile(request.args.get('profile'), request.args.get('quality'),
+                              request.args.get('overlay'))
+    except ValueError as e:
+        return Response(str(e), status=400)
+    return Response(gen(camera, profile, request.remote_addr),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/api/stats')
+def stats():
+    """Stream, camera and per-stage pipeline timing stats as JSON."""
+    return jsonify(webapp().streamInfo())
+
+@app.route('/api/cv')
+def cv_result():
+    """Latest CV detection record, the same JSON as the websocket feed."""
+    return Response(Camera.detections.latest.data or '{}', mimetype='application/json')
+
+@app.route('/api/clips')
+def clips():
+    """Saved motion clips, newest first."""
+    return jsonify(clip_recorder.list_clips())
+
+@app.route('/api/clips/<name>')
+def clip(name):
+    if name not in [c['name'] for c in clip_recorder.list_clips()]:
+        return Response('unknown clip', status=404)
+    return send_from_directory(clip_recorder.CLIP_DIR, name, as_attachment=True)
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 @app.route('/api/img/<path:filename>')
@@ -67,8 +127,12 @@ class webapp:
         commandAct(inputCommand, valueA)
 
     def modeselect(self, modeInput):
-        Camera.modeSelect = modeInput
+        # one mode, 'mode1+mode2' or a list of modes; 'none' switches CV off
+        if isinstance(modeInput, str):
+            modeInput = modeInput.split('+')
         Camera.CVMode = 'no'
+        Camera.set_modes(*modeInput)
+        Camera.ensure_running()
 
     def colorFindSet(self, H, S, V):
         camera.colorFindSet(H, S, V)
@@ -81,5 +145,17 @@ class webapp:
         fps_threading.setDaemon(False)
         fps_threading.start()
 
+    def streamInfo(self):
+        return {
+            'camera': Camera.lifecycle_stats(),
+            'ring': Camera.ring.stats() if Camera.ring else None,
+            'clients': stream_flow.stats(),
+            'pipeline': pipeline_stats.snapshot(),
+            'cv': Camera.cvt.stats() if Camera.cvt else None,
+            'clips': Camera.recorder.stats() if Camera.recorder else None,
+            'serial': robot.stats(),
+            'telemetry': robot.telemetry.snapshot,
+        }
+
     def sendIP(self, ipInput):
         camera.upperIP(ipInput)
\ No newline at end of file
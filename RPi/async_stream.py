@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# File name   : async_stream.py
+# Description : MJPEG streaming served from the asyncio loop, no thread per viewer.
+import asyncio
+import struct
+import time
+from urllib.parse import urlsplit, parse_qs
+from camera_opencv import Camera
+from stream_profile import get_profile
+import stream_flow
+import pipeline_stats
+
+MJPEG_PORT = 5001
+
+VIDEO_HEADER = struct.Struct('!2sBBId')
+VIDEO_VERSION = 1
+
+_sources = {}
+_records = None  # AsyncFrameSource of Camera.detections while somebody listens
+
+
+class AsyncFrameSource(object):
+    """Awaitable view of one profile's FrameBroadcast inside an event loop.
+
+    The camera thread notifies the loop once per frame, however many viewers
+    await the source, and all of them are woken by one asyncio.Event.
+    """
+    def __init__(self, broadcast, loop):
+        self.broadcast = broadcast
+        self.loop = loop
+        self.waiters = 0
+        self._event = asyncio.Event()
+        self._pending = False
+        broadcast.add_listener(self._on_publish)
+
+    def close(self):
+        self.broadcast.remove_listener(self._on_publish)
+
+    def _on_publish(self, frame):
+        # camera thread; collapse bursts into a single wake-up of the loop
+        if not self._pending:
+            self._pending = True
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self._pending = False
+        event = self._event
+        self._event = asyncio.Event()
+        event.set()
+
+    async def wait(self, after_seq=0, timeout=None):
+        """Return the first Frame newer than after_seq (None on timeout)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.broadcast.latest
+            if frame.seq > after_seq:
+                return frame
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(self._event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+
+def subscribe(profile):
+    """Subscribe to a profile and return its AsyncFrameSource for this loop."""
+    Camera.subscribe(profile)
+    source = _sources.get(profile)
+    if source is None:
+        source = AsyncFrameSource(Camera.broadcasts[profile], asyncio.get_running_loop())
+        _sources[profile] = source
+    source.waiters += 1
+    return source
+
+
+def unsubscribe(profile):
+    source = _sources.get(profile)
+    if source is not None:
+        source.waiters -= 1
+        if source.waiters <= 0:
+            source.close()
+            del _sources[profile]
+    Camera.unsubscribe(profile)
+
+
+def video_message(frame):
+    """Binary websocket message for a frame: VIDEO_HEADER followed by the JPEG.
+
+    Header (network byte order, 16 bytes): b'WV', version, flags (0),
+    uint32 frame sequence, float64 capture time in seconds since the epoch.
+    """
+    return VIDEO_HEADER.pack(b'WV', VIDEO_VERSION, 0, frame.seq & 0xffffffff, frame.timestamp) + frame.data
+
+
+async def deliver(send, profile, remote=None):
+    """Await frames of a profile and pass each one to send(frame) until cancelled.
+
+    send is awaited before the next frame is picked, and the next frame is
+    always the newest one, so at most one frame is ever pending per client.
+    """
+    flow = stream_flow.ClientFlow(profile, remote)
+    stream_flow.register(flow)
+    subscribed = flow.profile
+    source = subscribe(subscribed)
+    try:
+        # skip the frame the broadcast still holds from before this client
+        seq = source.broadcast.latest.seq
+        while True:
+            frame = await source.wait(seq)
+            seq = frame.seq
+            if not flow.should_send(time.time()):
+                continue
+            written = time.time()
+            pipeline_stats.record('delivery', written - frame.timestamp, Camera.modeSelect)
+            await send(frame)
+            flow.record_write(time.time() - written, frame.seq)
+            if flow.profile != subscribed:
+                source = subscribe(flow.profile)
+                unsubscribe(subscribed)
+                subscribed = flow.profile
+    finally:
+        unsubscribe(subscribed)
+        stream_flow.unregister(flow)
+
+
+async def deliver_records(send):
+    """Pass each CV detection record (a JSON string) to send(frame) until cancelled.
+
+    Like deliver(), at most one record is pending per client; a slow client
+    skips records, never frames of the video.
+    """
+    global _records
+    if _records is None:
+        _records = AsyncFrameSource(Camera.detections, asyncio.get_running_loop())
+    source = _records
+    source.waiters += 1
+    try:
+        seq = source.broadcast.latest.seq
+        while True:
+            frame = await source.wait(seq)
+            seq = frame.seq
+            await send(frame)
+    finally:
+        source.waiters -= 1
+        if source.waiters <= 0:
+            source.close()
+            _records = None
+
+
+async def stream(writer, profile, remote=None):
+    """Write the multipart stream for one viewer until it disconnects."""
+    async def send(frame):
+        writer.write(b'--frame\r\n'
+                     b'Content-Type: image/jpeg\r\n\r\n' + frame.data + b'\r\n')
+        # drain() returns once the socket buffer has room again, which is
+        # the same backpressure signal the Flask path measures
+        await writer.drain()
+    await deliver(send, profile, remote)
+
+
+async def handle_http(reader, writer):
+    """Minimal HTTP/1.x handler serving GET /video_feed."""
+    remote = writer.get_extra_info('peername')
+    remote = remote[0] if remote else None
+    try:
+        request_line = await reader.readline()
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2 or parts[0] != 'GET' or urlsplit(parts[1]).path != '/video_feed':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return
+        query = parse_qs(urlsplit(parts[1]).query)
+        try:
+            profile = get_profile(query.get('profile', [None])[0], query.get('quality', [None])[0],
+                                  query.get('overlay', [None])[0])
+        except ValueError as e:
+            body = str(e).encode()
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: %d\r\n'
+                         b'Connection: close\r\n\r\n' % len(body) + body)
+            return
+
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Access-Control-Allow-Origin: *\r\n'
+                     b'Connection: close\r\n\r\n')
+        await stream(writer, profile, remote)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host='0.0.0.0', port=MJPEG_PORT):
+    """Start the MJPEG server on the running loop and return it."""
+    server = await asyncio.start_server(handle_http, host, port)
+    print(f"INFO: asyncio MJPEG server on port {port} (/video_feed)")
+    return server
@@ -1,105 +1,310 @@
 import time
 import threading
+import collections
 import cv2
-try:
-    from greenlet import getcurrent as get_ident
-except ImportError:
-    try:
-        from thread import get_ident
-    except ImportError:
-        from _thread import get_ident
-
-
-class CameraEvent(object):
-    """An Event-like class that signals all active clients when a new frame is
-    available.
+import jpeg_encoder
+import pipeline_stats
+from stream_profile import DEFAULT_PROFILE
+
+
+Frame = collections.namedtuple('Frame', ['seq', 'timestamp', 'data'])
+
+
+class FrameBroadcast(object):
+    """Latest-frame broadcast that signals all active clients when a new frame
+    is available.
+
+    Every published frame gets a monotonically increasing sequence number and
+    a capture timestamp. Clients wait for "a frame newer than N" instead of
+    owning a per-thread event, so publishing costs the same no matter how many
+    viewers are connected, and a client can tell from the sequence gap how
+    many frames it skipped.
     """
     def __init__(self):
-        self.events = {}
-
-    def wait(self):
-        """Invoked from each client's thread to wait for the next frame."""
-        ident = get_ident()
-        if ident not in self.events:
-            # this is a new client
-            # add an entry for it in the self.events dict
-            # each entry has two elements, a threading.Event() and a timestamp
-            self.events[ident] = [threading.Event(), time.time()]
-        return self.events[ident][0].wait()
-
-    def set(self):
-        """Invoked by the camera thread when a new frame is available."""
-        now = time.time()
-        remove = None
-        for ident, event in self.events.items():
-            if not event[0].isSet():
-                # if this client's event is not set, then set it
-                # also update the last set timestamp to now
-                event[0].set()
-                event[1] = now
-            else:
-                # if the client's event is already set, it means the client
-                # did not process a previous frame
-                # if the event stays set for more than 5 seconds, then assume
-                # the client is gone and remove it
-                if now - event[1] > 5:
-                    remove = ident
-        if remove:
-            del self.events[remove]
+        self._lock = threading.Lock()
+        self._latest = Frame(0, 0.0, None)
+        self._event = threading.Event()
+        self._listeners = ()
+
+    def add_listener(self, callback):
+        """Call callback(frame) from the publishing thread on every frame.
+
+        Meant for bridges such as one asyncio loop, not for every client.
+        """
+        with self._lock:
+            self._listeners = self._listeners + (callback,)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners = tuple(l for l in self._listeners if l is not callback)
+
+    @property
+    def latest(self):
+        """The most recently published frame (seq 0 if nothing was published)."""
+        return self._latest
+
+    def publish(self, data, timestamp=None, seq=None):
+        """Invoked by the camera thread when a new frame is available.
 
-    def clear(self):
-        """Invoked from each client's thread after a frame was processed."""
-        self.events[get_ident()][0].clear()
+        seq lets derived streams (e.g. encoded profiles) reuse the sequence
+        number of the capture they were made from.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if seq is None:
+                seq = self._latest.seq + 1
+            frame = Frame(seq, timestamp, data)
+            event = self._event
+            self._latest = frame
+            self._event = threading.Event()
+            listeners = self._listeners
+        # wake everybody waiting on the previous generation
+        event.set()
+        for callback in listeners:
+            callback(frame)
+        return frame
+
+    def wait(self, after_seq=0, timeout=None):
+        """Invoked from each client to wait for a frame newer than after_seq.
+
+        Returns the newest Frame, or None if the timeout expired first.
+        """
+        while True:
+            with self._lock:
+                frame = self._latest
+                event = self._event
+            if frame.seq > after_seq:
+                return frame
+            if not event.wait(timeout):
+                return None
+
+
+# capture lifecycle states
+STOPPED = 'stopped'  # no thread, sensor closed
+STANDBY = 'standby'  # sensor running, nothing is encoded
+STREAMING = 'streaming'  # at least one viewer, active profiles are encoded
+
+STANDBY_TIMEOUT = 30  # seconds without viewers or CV before the sensor is closed
+STANDBY_POLL = 0.1  # standby re-checks for viewers/CV at least this often
 
 
 class BaseCamera(object):
     thread = None  # background thread that reads frames from camera
-    frame = None  # current frame is stored here by background thread
+    frame = None  # current raw (unencoded) frame is stored here by background thread
     last_access = 0  # time of last client access to the camera
-    event = CameraEvent()
+    raw = FrameBroadcast()  # every captured image, before encoding; buffers
+                            # may be reused by the camera once newer frames exist
+    broadcasts = {}  # StreamProfile -> FrameBroadcast of encoded JPEGs
+    subscribers = {}  # StreamProfile -> number of clients streaming it
+    active_profiles = ()  # profiles that get encoded on every frame, clean ones first
+    encoder = None  # jpeg_encoder backend, picked when the thread first starts
+    state = STOPPED
+    stopping = None  # thread that decided to stop and is still closing the sensor
+    wake_time = None  # when the first viewer arrived while not streaming
+    lifecycle = {'wakeups': 0, 'first_frame_ms': None, 'first_frame_max_ms': 0.0}
+    _lock = threading.Lock()
+    _wake = threading.Event()
 
     def __init__(self):
         """Start the background camera thread if it isn't running yet."""
-        if BaseCamera.thread is None:
+        if self.ensure_running():
+            # wait until the sensor delivers frames
+            BaseCamera.raw.wait(0)
+
+    @classmethod
+    def ensure_running(cls):
+        """Start the camera thread unless it is running; wake it from standby.
+
+        Returns True if a new thread was started.
+        """
+        BaseCamera._wake.set()
+        with BaseCamera._lock:
+            if BaseCamera.thread is not None:
+                return False
+            if BaseCamera.encoder is None:
+                BaseCamera.encoder = jpeg_encoder.select_encoder()
             BaseCamera.last_access = time.time()
 
-            # start background frame thread
-            BaseCamera.thread = threading.Thread(target=self._thread)
+            # start background frame thread; it waits for a previous thread
+            # that is still releasing the sensor
+            previous = BaseCamera.stopping
+            BaseCamera.thread = threading.Thread(target=cls._thread, args=(previous,))
             BaseCamera.thread.start()
+            return True
 
-            # wait until frames are available
-            while self.get_frame() is None:
-                time.sleep(0)
+    @classmethod
+    def subscribe(cls, profile=DEFAULT_PROFILE):
+        """Register a client for a profile so it gets encoded on every frame."""
+        with BaseCamera._lock:
+            if profile not in BaseCamera.broadcasts:
+                BaseCamera.broadcasts[profile] = FrameBroadcast()
+            if not BaseCamera.subscribers and BaseCamera.wake_time is None:
+                BaseCamera.wake_time = time.time()
+            BaseCamera.subscribers[profile] = BaseCamera.subscribers.get(profile, 0) + 1
+            BaseCamera.active_profiles = BaseCamera._encode_order()
+        cls.ensure_running()
 
-    def get_frame(self):
-        """Return the current camera frame."""
-        BaseCamera.last_access = time.time()
+    @classmethod
+    def unsubscribe(cls, profile=DEFAULT_PROFILE):
+        """Drop a client; the profile stops being encoded with its last client."""
+        with BaseCamera._lock:
+            count = BaseCamera.subscribers.get(profile, 0) - 1
+            if count > 0:
+                BaseCamera.subscribers[profile] = count
+            else:
+                BaseCamera.subscribers.pop(profile, None)
+            BaseCamera.active_profiles = BaseCamera._encode_order()
+
+    @staticmethod
+    def _encode_order():
+        # clean profiles are encoded before the overlays are drawn, so the
+        # overlays can go straight into the captured image
+        return tuple(sorted(BaseCamera.subscribers, key=lambda profile: profile.overlay))
 
-        # wait for a signal from the camera thread
-        BaseCamera.event.wait()
-        BaseCamera.event.clear()
+    @classmethod
+    def lifecycle_stats(cls):
+        """Return the capture state and the measured viewer wake-up latency."""
+        stats = dict(BaseCamera.lifecycle)
+        stats['state'] = BaseCamera.state
+        return stats
+
+    def wait_frame(self, after_seq=0, timeout=None, profile=DEFAULT_PROFILE):
+        """Return the first encoded Frame newer than after_seq (None on timeout).
 
-        return BaseCamera.frame
+        The caller must hold a subscription for the profile.
+        """
+        BaseCamera.last_access = time.time()
+        return BaseCamera.broadcasts[profile].wait(after_seq, timeout)
+
+    def get_frame(self, profile=DEFAULT_PROFILE):
+        """Return the next camera frame as JPEG bytes."""
+        self.subscribe(profile)
+        try:
+            last_seq = BaseCamera.broadcasts[profile].latest.seq
+            return self.wait_frame(last_seq, profile=profile).data
+        finally:
+            self.unsubscribe(profile)
 
     @staticmethod
     def frames():
-        """"Generator that returns frames from the camera."""
+        """"Generator that returns raw images from the camera."""
         raise RuntimeError('Must be implemented by subclasses.')
 
+    @staticmethod
+    def needs_capture():
+        """Whether frames are needed even without viewers (e.g. a CV mode)."""
+        return False
+
+    @staticmethod
+    def cv_mode():
+        """Name of the active CV mode, used to label pipeline timings."""
+        return 'none'
+
+    @staticmethod
+    def annotate(img):
+        """Draw the overlays for profiles with overlay=True; may draw in place."""
+        return img
+
+    @staticmethod
+    def encode(img, profile):
+        """Encode a raw image as JPEG bytes for a profile."""
+        height, width = img.shape[:2]
+        if (width, height) != (profile.width, profile.height):
+            img = cv2.resize(img, (profile.width, profile.height), interpolation=cv2.INTER_AREA)
+        return BaseCamera.encoder.encode(img, profile.quality)
+
+    @classmethod
+    def _capture(cls, frames_iterator):
+        """Pull one image from the generator and publish it raw; None at the end."""
+        # the generator captures as soon as it is resumed, so this is
+        # the closest we get to the sensor timestamp
+        captured = time.time()
+        try:
+            img = next(frames_iterator)
+        except StopIteration:
+            return None
+        BaseCamera.frame = img
+        return BaseCamera.raw.publish(img, captured)
+
     @classmethod
-    def _thread(cls):
-        """Camera background thread."""
+    def _thread(cls, previous=None):
+        """Camera background thread.
+
+        Streams while anybody is subscribed, keeps the sensor in warm standby
+        (capturing only if a CV mode needs frames, never encoding) when nobody
+        is, and closes the sensor after STANDBY_TIMEOUT of standby without CV.
+        """
+        if previous is not None:
+            previous.join()
         print('Starting camera thread.')
         frames_iterator = cls.frames()
-        for frame in frames_iterator:
-            BaseCamera.frame = frame
-            BaseCamera.event.set()  # send signal to clients
+        # the first capture starts the sensor
+        frame = cls._capture(frames_iterator)
+        idle_since = time.time()
+        while frame is not None:
+            profiles = BaseCamera.active_profiles
+            if not profiles:
+                BaseCamera.state = STANDBY
+                if not cls.needs_capture():
+                    with BaseCamera._lock:
+                        if (not BaseCamera.active_profiles
+                                and time.time() - idle_since > STANDBY_TIMEOUT):
+                            BaseCamera.thread = None
+                            BaseCamera.stopping = threading.current_thread()
+                            print('Stopping camera thread due to inactivity.')
+                            break
+                    # sensor stays open, wake up as soon as a viewer arrives
+                    BaseCamera._wake.wait(STANDBY_POLL)
+                    BaseCamera._wake.clear()
+                    continue
+                frame = cls._capture(frames_iterator)
+                idle_since = time.time()
+                continue
+
+            BaseCamera.state = STREAMING
+            frame = cls._capture(frames_iterator)
+            if frame is None:
+                break
+            # each distinct profile is encoded once and shared by all of its
+            # clients; the frames keep the capture sequence number. The
+            # overlays are drawn once, and only if a profile shows them
+            mode = cls.cv_mode()
+            img = frame.data
+            annotated = False
+            for profile in profiles:
+                if profile.overlay and not annotated:
+                    img = cls.annotate(img)
+                    annotated = True
+                encode_start = time.time()
+                try:
+                    data = cls.encode(img, profile)
+                except Exception as e:
+                    print(f"Error encoding frame: {e}")
+                    continue
+                pipeline_stats.record('encode', time.time() - encode_start, mode)
+                BaseCamera.broadcasts[profile].publish(data, frame.timestamp, frame.seq)
+            cls._record_wake_latency()
+            idle_since = time.time()
             time.sleep(0)
 
-            # if there hasn't been any clients asking for frames in
-            # the last 10 seconds then stop the thread
-            # if time.time() - BaseCamera.last_access > 10:
-            #     frames_iterator.close()
-            #     print('Stopping camera thread due to inactivity.')
-            #     break
-        BaseCamera.thread = None
+        with BaseCamera._lock:
+            if BaseCamera.thread is threading.current_thread():
+                BaseCamera.thread = None
+                BaseCamera.stopping = threading.current_thread()
+        frames_iterator.close()
+        BaseCamera.state = STOPPED
+
+    @classmethod
+    def _record_wake_latency(cls):
+        """Measure the time from a viewer arriving to its first encoded frame."""
+        wake_time = BaseCamera.wake_time
+        if wake_time is None:
+            return
+        BaseCamera.wake_time = None
+        latency = (time.time() - wake_time) * 1000.0
+        lifecycle = BaseCamera.lifecycle
+        lifecycle['wakeups'] += 1
+        lifecycle['first_frame_ms'] = round(latency, 1)
+        lifecycle['first_frame_max_ms'] = round(max(lifecycle['first_frame_max_ms'], latency), 1)
+        print('INFO: first frame for new viewer after %.1f ms' % latency)
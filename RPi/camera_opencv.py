@@ -1,18 +1,28 @@
 import os
+import json
 import cv2
-from base_camera import BaseCamera
+from base_camera import BaseCamera, FrameBroadcast
+from frame_ring import FrameRing
+from overlay import OverlayCache
+import pipeline_stats
+import cv_detect
+import cv_workers
+import cv_modes
+from gimbal_control import GimbalController
+import collections
+import clip_recorder
+from stream_profile import get_profile
 import numpy as np
 import robot
 import datetime
 import time
 import threading
-import imutils
 import platform
 
 # Only import picamera2 on Raspberry Pi
 if platform.system() != "Windows":
     try:
-        from picamera2 import Picamera2
+        from picamera2 import Picamera2, MappedArray
         PICAMERA_AVAILABLE = True
     except ImportError:
         PICAMERA_AVAILABLE = False
@@ -24,23 +34,44 @@ else:
 curpath = os.path.realpath(__file__)
 thisPath = os.path.dirname(curpath)
 
-faceCascade = cv2.CascadeClassifier(os.path.join(thisPath, 'haarcascade_frontalface_default.xml'))
+faceCascadePath = os.path.join(thisPath, 'haarcascade_frontalface_default.xml')
 
 upperGlobalIP = 'UPPER IP'
 
 linePos_1 = 440
 linePos_2 = 380
+lineScanRows = (440, 410, 380, 320, 260)  # scanlines for angle/curvature, linePos_1/2 are always scanned
 lineColorSet = 255
 frameRender = 1
 findLineError = 20
+faceDetectInterval = 10  # frames between full face detections, tracking in between
+faceDistance = 2.0  # metres, furthest face to detect; sets the detection resolution
 
 colorUpper = np.array([44, 255, 255])
 colorLower = np.array([24, 100, 100])
+colorStep = 2  # findColor masks every colorStep-th pixel in both directions
+colorMinArea = 100  # stream pixels, smaller blobs are ignored
+motionSensitivity = 5  # gray level change that counts as motion
+motionMinArea = 2000  # stream pixels
+motionHold = 0.5  # seconds a motion box stays up after the last motion
+motionWidth = 160  # width of the thumbnail watchDog works on
+gimbalGain = 0.05  # findColor head steps per pixel of error and control tick
+gimbalRate = 20.0  # Hz, findColor head control ticks, independent of the frame rate
 
 speedMove = 100
 
+# what the CV thread does with a mode: method names for the detection
+# parameters, applying a result, drawing the overlay and switching it off
+CVHandler = collections.namedtuple('CVHandler', ['params', 'apply', 'draw', 'stop'])
+
 class CVThread(threading.Thread):
     font = cv2.FONT_HERSHEY_SIMPLEX
+    HANDLERS = {
+        'faceDetection': CVHandler('faceParams', 'applyFaces', 'drawFaces', None),
+        'findColor': CVHandler('colorParams', 'applyColor', 'drawColor', None),
+        'findlineCV': CVHandler('lineParams', 'applyLine', 'drawLine', 'stopLine'),
+        'watchDog': CVHandler('motionParams', 'applyMotion', 'drawMotion', None),
+    }
     # ... (der Rest dieser Klasse bleibt komplett unverÃ¤ndert) ...
     # ... ich kÃ¼rze sie hier ab, um die Ãœbersicht zu wahren.
     # Du musst hier nichts Ã¤ndern!
@@ -49,13 +80,18 @@ class CVThread(threading.Thread):
     videoW = 640
     videoH = 480
     tor = 27
-    aspd = 0.005
 
 
     def __init__(self, *args, **kwargs):
         self.CVThreading = 0
         self.CVMode = 'none'
+        self.CVModes = ()
         self.imgCV = None
+        self.lease = None
+        self.leaseLock = threading.Lock()
+        self.capturedAt = None
+        self.seq = None
+        self.appliedAt = 0
         self.faces = None
 
         self.mov_x = None
@@ -84,153 +120,199 @@ class CVThread(threading.Thread):
         self.__flag = threading.Event()
         self.__flag.clear()
 
-        self.avg = None
+        self.pipeline = cv_modes.Pipeline(faceCascadePath)
+        self.colorBlobs = ()
+        self.faceDetectRate = pipeline_stats.Rate()
+        self.faceUpdateRate = pipeline_stats.Rate()
         self.motionCounter = 0
         self.lastMovtionCaptured = datetime.datetime.now()
-        self.frameDelta = None
-        self.thresh = None
-        self.cnts = None
 
         self.CVCommand = 'forward'
-
-
-    def mode(self, invar, imgInput):
-        self.CVMode = invar
-        self.imgCV = imgInput
+        self.resultCapturedAt = None
+        self.gimbal = GimbalController(self.gimbalStep, center=(CVThread.videoW // 2, CVThread.videoH // 2),
+                                       deadband=CVThread.tor, gain=gimbalGain, rate=gimbalRate)
+
+        self.overlays = OverlayCache()
+        self.lineScan = None
+        self.renderFrame = None
+
+
+    def mode(self, invar, imgInput, lease=None, capturedAt=None, seq=None):
+        # invar is the tuple of active modes; lease keeps the frame ring
+        # slot of imgInput from being overwritten until the CV pass is
+        # done; a frame that was handed over but not picked up yet is given back.
+        # seq is the frame's sequence number in the streams, for the detection feed
+        with self.leaseLock:
+            pending = self.lease
+            self.CVModes = invar
+            self.CVMode = '+'.join(invar) or 'none'
+            self.imgCV = imgInput
+            self.lease = lease
+            self.capturedAt = capturedAt
+            self.seq = seq
+        if pending is not None:
+            pending.release()
         self.resume()
 
+    def takeFrame(self):
+        with self.leaseLock:
+            lease = self.lease
+            self.lease = None
+            return self.imgCV, lease, self.capturedAt, self.seq
 
-    def elementDraw(self,imgInput):
-        if self.CVMode == 'none':
-            pass
 
-        elif self.CVMode == 'faceDetection':
-            if len(self.faces):
-                if len(self.faces) == 1:
-                    cv2.putText(imgInput,'1 Face Detected',(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-                else:
-                    cv2.putText(imgInput,'%d Faces Detected'%len(self.faces),(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-            else:
-                cv2.putText(imgInput,'Face Detecting',(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-            for (x,y,w,h) in self.faces:
-                cv2.rectangle(imgInput,(x,y),(x+w,y+h),(64,128,255),2)
-
-        elif self.CVMode == 'findColor':
-            if self.findColorDetection:
-                cv2.putText(imgInput,'Target Detected',(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-                self.drawing = 1
-            else:
-                cv2.putText(imgInput,'Target Detecting',(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-                self.drawing = 0
+    def drawLabel(self, imgInput, text, org=(40,60)):
+        self.overlays.stamp(imgInput, ('label', text, org),
+            lambda layer: layer.text(text, org, (255,255,255)))
 
-            if self.radius > 10 and self.drawing:
-                cv2.rectangle(imgInput,(int(self.box_x-self.radius),int(self.box_y+self.radius)),(int(self.box_x+self.radius),int(self.box_y-self.radius)),(255,255,255),1)
 
-        elif self.CVMode == 'findlineCV':
-            if frameRender:
-                imgInput = cv2.cvtColor(imgInput, cv2.COLOR_BGR2GRAY)
-                retval_bw, imgInput =  cv2.threshold(imgInput, 0, 255, cv2.THRESH_OTSU)
-                imgInput = cv2.erode(imgInput, None, iterations=6)
-            try:
-                if lineColorSet == 255:
-                    cv2.putText(imgInput,('Following White Line'),(30,50), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(255,255,255),1,cv2.LINE_AA)
-                    cv2.putText(imgInput,('Following White Line'),(230,50), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(0,0,0),1,cv2.LINE_AA)
-                else:
-                    cv2.putText(imgInput,('Following Black Line'),(30,50), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(255,255,255),1,cv2.LINE_AA)
-                    cv2.putText(imgInput,('Following Black Line'),(230,50), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(0,0,0),1,cv2.LINE_AA)
+    def drawLineGuides(self, layer):
+        # static part of the findlineCV overlay, rebuilt when a setting changes
+        if lineColorSet == 255:
+            title = 'Following White Line'
+        else:
+            title = 'Following Black Line'
+        layer.text(title, (30,50), (255,255,255))
+        layer.text(title, (230,50), (0,0,0))
 
-                cv2.putText(imgInput,(self.CVCommand),(30,90), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(255,255,255),1,cv2.LINE_AA)
-                cv2.putText(imgInput,(self.CVCommand),(230,90), cv2.FONT_HERSHEY_SIMPLEX, 0.5,(0,0,0),1,cv2.LINE_AA)
+        layer.line((0,linePos_1),(640,linePos_1),(255,255,255),1)
+        layer.line((0,linePos_1+1),(640,linePos_1+1),(0,0,0),1)
 
-                cv2.line(imgInput,(self.left_Pos1,(linePos_1+30)),(self.left_Pos1,(linePos_1-30)),(255,255,255),1)
-                cv2.line(imgInput,((self.left_Pos1+1),(linePos_1+30)),((self.left_Pos1+1),(linePos_1-30)),(0,0,0),1)
+        layer.line((320-findLineError,0),(320-findLineError,480),(255,255,255),1)
+        layer.line((320+findLineError,0),(320+findLineError,480),(255,255,255),1)
 
-                cv2.line(imgInput,(self.right_Pos1,(linePos_1+30)),(self.right_Pos1,(linePos_1-30)),(255,255,255),1)
-                cv2.line(imgInput,((self.right_Pos1-1),(linePos_1+30)),((self.right_Pos1-1),(linePos_1-30)),(0,0,0),1)
+        layer.line((320-findLineError+1,0),(320-findLineError+1,480),(0,0,0),1)
+        layer.line((320+findLineError-1,0),(320+findLineError-1,480),(0,0,0),1)
 
-                cv2.line(imgInput,(0,linePos_1),(640,linePos_1),(255,255,255),1)
-                cv2.line(imgInput,(0,linePos_1+1),(640,linePos_1+1),(0,0,0),1)
+        layer.line((0,linePos_2),(640,linePos_2),(255,255,255),1)
+        layer.line((0,linePos_2+1),(640,linePos_2+1),(0,0,0),1)
 
-                cv2.line(imgInput,(320-findLineError,0),(320-findLineError,480),(255,255,255),1)
-                cv2.line(imgInput,(320+findLineError,0),(320+findLineError,480),(255,255,255),1)
+        for row in lineScanRows:
+            if row not in (linePos_1, linePos_2):
+                layer.line((0,row),(16,row),(255,255,255),1)
+                layer.line((624,row),(640,row),(255,255,255),1)
 
-                cv2.line(imgInput,(320-findLineError+1,0),(320-findLineError+1,480),(0,0,0),1)
-                cv2.line(imgInput,(320+findLineError-1,0),(320+findLineError-1,480),(0,0,0),1)
 
-                cv2.line(imgInput,(self.left_Pos2,(linePos_2+30)),(self.left_Pos2,(linePos_2-30)),(255,255,255),1)
-                cv2.line(imgInput,(self.right_Pos2,(linePos_2+30)),(self.right_Pos2,(linePos_2-30)),(255,255,255),1)
-                cv2.line(imgInput,(0,linePos_2),(640,linePos_2),(255,255,255),1)
+    def drawLineCommand(self, layer):
+        layer.text(self.CVCommand, (30,90), (255,255,255))
+        layer.text(self.CVCommand, (230,90), (0,0,0))
 
-                cv2.line(imgInput,(self.left_Pos2+1,(linePos_2+30)),(self.left_Pos2+1,(linePos_2-30)),(0,0,0),1)
-                cv2.line(imgInput,(self.right_Pos2-1,(linePos_2+30)),(self.right_Pos2-1,(linePos_2-30)),(0,0,0),1)
-                cv2.line(imgInput,(0,linePos_2+1),(640,linePos_2+1),(0,0,0),1)
 
-                cv2.line(imgInput,((self.center-20),int((linePos_1+linePos_2)/2)),((self.center+20),int((linePos_1+linePos_2)/2)),(0,0,0),1)
-                cv2.line(imgInput,((self.center),int((linePos_1+linePos_2)/2+20)),((self.center),int((linePos_1+linePos_2)/2-20)),(0,0,0),1)
+    def elementDraw(self,imgInput):
+        # labels and guides come from cached layers, only the detections
+        # (boxes, line positions) are drawn per frame; with several modes
+        # their labels go below each other, under the line mode's text rows
+        top = 120 if 'findlineCV' in self.CVModes else 60
+        for i, mode in enumerate(self.CVModes):
+            # findlineCV comes first and has no label, so the labels start at i = 0 or 1
+            row = i - 1 if top == 120 else i
+            imgInput = getattr(self, CVThread.HANDLERS[mode].draw)(imgInput, (40, top + 30*row))
+        return imgInput
 
-                cv2.line(imgInput,((self.center-20),int((linePos_1+linePos_2)/2+1)),((self.center+20),int((linePos_1+linePos_2)/2+1)),(255,255,255),1)
-                cv2.line(imgInput,((self.center+1),int((linePos_1+linePos_2)/2+20)),((self.center+1),int((linePos_1+linePos_2)/2-20)),(255,255,255),1)
-            except:
-                pass
 
-        elif self.CVMode == 'watchDog':
-            if self.drawing:
-                cv2.putText(imgInput,'Motion Detected',(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-                robot.lightCtrl('red', 0)
-                cv2.rectangle(imgInput, (self.mov_x, self.mov_y), (self.mov_x + self.mov_w, self.mov_y + self.mov_h), (128, 255, 0), 1)
+    def drawFaces(self, imgInput, org):
+        faces = self.faces if self.faces is not None else ()
+        if len(faces):
+            if len(faces) == 1:
+                self.drawLabel(imgInput, '1 Face Detected', org)
             else:
-                cv2.putText(imgInput,'Motion Detecting',(40,60), CVThread.font, 0.5,(255,255,255),1,cv2.LINE_AA)
-                robot.lightCtrl('blue', 0)
+                self.drawLabel(imgInput, '%d Faces Detected'%len(faces), org)
+        else:
+            self.drawLabel(imgInput, 'Face Detecting', org)
+        for (x,y,w,h) in faces:
+            cv2.rectangle(imgInput,(x,y),(x+w,y+h),(64,128,255),2)
+        return imgInput
+
 
+    def drawColor(self, imgInput, org):
+        if self.findColorDetection:
+            self.drawLabel(imgInput, 'Target Detected', org)
+        else:
+            self.drawLabel(imgInput, 'Target Detecting', org)
+
+        if self.radius > 10 and self.findColorDetection:
+            cv2.rectangle(imgInput,(int(self.box_x-self.radius),int(self.box_y+self.radius)),(int(self.box_x+self.radius),int(self.box_y-self.radius)),(255,255,255),1)
+            for (x,y,w,h,area) in self.colorBlobs[1:]:
+                cv2.rectangle(imgInput,(x,y),(x+w,y+h),(128,128,128),1)
         return imgInput
 
 
-    def watchDog(self, imgInput):
+    def drawLine(self, imgInput, org):
+        lineScan = self.lineScan
+        if frameRender and lineScan is not None and lineScan.bands is not None:
+            # only the scanline bands are ever binarized, show those on black
+            if self.renderFrame is None or self.renderFrame.shape != imgInput.shape[:2]:
+                self.renderFrame = np.empty(imgInput.shape[:2], np.uint8)
+            self.renderFrame.fill(0)
+            rows, bands = lineScan.bands
+            half = bands.shape[1] // 2
+            for row, band in zip(rows, bands):
+                self.renderFrame[row-half:row+half+1] = band
+            imgInput = self.renderFrame
+
+        self.overlays.stamp(imgInput, ('lineGuides', lineColorSet, linePos_1, linePos_2, findLineError,
+            tuple(lineScanRows)), self.drawLineGuides)
+        if lineScan is not None:
+            for (row, x) in lineScan.points:
+                cv2.circle(imgInput, (x, row), 3, (255,255,255), 1)
+        self.overlays.stamp(imgInput, ('lineCommand', self.CVCommand), self.drawLineCommand)
+        try:
+            cv2.line(imgInput,(self.left_Pos1,(linePos_1+30)),(self.left_Pos1,(linePos_1-30)),(255,255,255),1)
+            cv2.line(imgInput,((self.left_Pos1+1),(linePos_1+30)),((self.left_Pos1+1),(linePos_1-30)),(0,0,0),1)
+
+            cv2.line(imgInput,(self.right_Pos1,(linePos_1+30)),(self.right_Pos1,(linePos_1-30)),(255,255,255),1)
+            cv2.line(imgInput,((self.right_Pos1-1),(linePos_1+30)),((self.right_Pos1-1),(linePos_1-30)),(0,0,0),1)
+
+            cv2.line(imgInput,(self.left_Pos2,(linePos_2+30)),(self.left_Pos2,(linePos_2-30)),(255,255,255),1)
+            cv2.line(imgInput,(self.right_Pos2,(linePos_2+30)),(self.right_Pos2,(linePos_2-30)),(255,255,255),1)
+
+            cv2.line(imgInput,(self.left_Pos2+1,(linePos_2+30)),(self.left_Pos2+1,(linePos_2-30)),(0,0,0),1)
+            cv2.line(imgInput,(self.right_Pos2-1,(linePos_2+30)),(self.right_Pos2-1,(linePos_2-30)),(0,0,0),1)
+
+            cv2.line(imgInput,((self.center-20),int((linePos_1+linePos_2)/2)),((self.center+20),int((linePos_1+linePos_2)/2)),(0,0,0),1)
+            cv2.line(imgInput,((self.center),int((linePos_1+linePos_2)/2+20)),((self.center),int((linePos_1+linePos_2)/2-20)),(0,0,0),1)
+
+            cv2.line(imgInput,((self.center-20),int((linePos_1+linePos_2)/2+1)),((self.center+20),int((linePos_1+linePos_2)/2+1)),(255,255,255),1)
+            cv2.line(imgInput,((self.center+1),int((linePos_1+linePos_2)/2+20)),((self.center+1),int((linePos_1+linePos_2)/2-20)),(255,255,255),1)
+        except:
+            pass
+        return imgInput
+
+
+    def drawMotion(self, imgInput, org):
+        if self.drawing:
+            self.drawLabel(imgInput, 'Motion Detected', org)
+            cv2.rectangle(imgInput, (self.mov_x, self.mov_y), (self.mov_x + self.mov_w, self.mov_y + self.mov_h), (128, 255, 0), 1)
+        else:
+            self.drawLabel(imgInput, 'Motion Detecting', org)
+        return imgInput
+
+
+    def applyMotion(self, boxes):
+        if boxes is None:
+            # background model is being started
+            return
         timestamp = datetime.datetime.now()
-        gray = cv2.cvtColor(imgInput, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-        if self.avg is None:
-            print("[INFO] starting background model...")
-            self.avg = gray.copy().astype("float")
-            return 'background model'
-
-        cv2.accumulateWeighted(gray, self.avg, 0.5)
-        self.frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
-
-        # threshold the delta image, dilate the thresholded image to fill
-        # in holes, then find contours on thresholded image
-        self.thresh = cv2.threshold(self.frameDelta, 5, 255,
-            cv2.THRESH_BINARY)[1]
-        self.thresh = cv2.dilate(self.thresh, None, iterations=2)
-        self.cnts = cv2.findContours(self.thresh.copy(), cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE)
-        self.cnts = imutils.grab_contours(self.cnts)
-        # print('x')
-        # loop over the contours
-        for c in self.cnts:
-            # if the contour is too small, ignore it
-            if cv2.contourArea(c) < 2000:
-                continue
-    
-            # compute the bounding box for the contour, draw it on the frame,
-            # and update the text
-            (self.mov_x, self.mov_y, self.mov_w, self.mov_h) = cv2.boundingRect(c)
+        for box in boxes:
+            # the last large enough contour is the one that gets drawn
+            (self.mov_x, self.mov_y, self.mov_w, self.mov_h) = box
             self.drawing = 1
-            
+
             self.motionCounter += 1
+            if Camera.recorder is not None:
+                Camera.recorder.trigger()
 
             self.lastMovtionCaptured = timestamp
 
-        if (timestamp - self.lastMovtionCaptured).seconds >= 0.5:
+        if (timestamp - self.lastMovtionCaptured).total_seconds() >= motionHold:
             self.drawing = 0
-
-        self.pause()
+        # set here and not in drawMotion, which only runs while an overlay is streamed
+        robot.lightCtrl('red' if self.drawing else 'blue', 0)
 
 
     def findLineTest(self, posInput, setCenter):#2
         if not posInput:
-            robot.robotCtrl.moveStart(speedMove, 'no', 'no')
+            # test mode only shows the command, it never drives
             return
 
         if posInput > (setCenter + findLineError):
@@ -245,7 +327,9 @@ class CVThread(threading.Thread):
 
     def findLineCtrl(self, posInput, setCenter):#2
         if not posInput:
-            robot.robotCtrl.moveStart(speedMove, 'no', 'no')
+            # no line found yet: stand still
+            robot.stopFB()
+            robot.stopLR()
             return
 
         if posInput > (setCenter + findLineError):
@@ -267,103 +351,142 @@ class CVThread(threading.Thread):
             print('Forward')
 
 
-    def findlineCV(self, frame_image):
-        frame_findline = cv2.cvtColor(frame_image, cv2.COLOR_BGR2GRAY)
-        retval, frame_findline =  cv2.threshold(frame_findline, 0, 255, cv2.THRESH_OTSU)
-        frame_findline = cv2.erode(frame_findline, None, iterations=6)
-        colorPos_1 = frame_findline[linePos_1]
-        colorPos_2 = frame_findline[linePos_2]
-        try:
-            lineColorCount_Pos1 = np.sum(colorPos_1 == lineColorSet)
-            lineColorCount_Pos2 = np.sum(colorPos_2 == lineColorSet)
-
-            lineIndex_Pos1 = np.where(colorPos_1 == lineColorSet)
-            lineIndex_Pos2 = np.where(colorPos_2 == lineColorSet)
-
-            if lineColorCount_Pos1 == 0:
-                lineColorCount_Pos1 = 1
-            if lineColorCount_Pos2 == 0:
-                lineColorCount_Pos2 = 1
-
-            self.left_Pos1 = lineIndex_Pos1[0][lineColorCount_Pos1-1]
-            self.right_Pos1 = lineIndex_Pos1[0][0]
-            self.center_Pos1 = int((self.left_Pos1+self.right_Pos1)/2)
-
-            self.left_Pos2 = lineIndex_Pos2[0][lineColorCount_Pos2-1]
-            self.right_Pos2 = lineIndex_Pos2[0][0]
-            self.center_Pos2 = int((self.left_Pos2+self.right_Pos2)/2)
-
-            self.center = int((self.center_Pos1+self.center_Pos2)/2)
-        except:
-            center = None
-            pass
+    def applyLine(self, lineScan):
+        self.lineScan = lineScan
+        # without a segment on a control line the previous positions are kept
+        if lineScan.center is not None:
+            (self.left_Pos1, self.right_Pos1, self.left_Pos2, self.right_Pos2, self.center) = lineScan[:5]
 
         if Camera.CVMode == 'run':
             self.findLineCtrl(self.center, 320)
         else:
             self.findLineTest(self.center, 320)
-        self.pause()
-
-
-    def findColor(self, frame_image):
-        hsv = cv2.cvtColor(frame_image, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(hsv, colorLower, colorUpper)#1
-        mask = cv2.erode(mask, None, iterations=2)
-        mask = cv2.dilate(mask, None, iterations=2)
-        cnts = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE)[-2]
-        center = None
-        if len(cnts) > 0:
-            X_LOCK = 0
-            Y_LOCK = 0
-            self.findColorDetection = 1
-            c = max(cnts, key=cv2.contourArea)
-            ((self.box_x, self.box_y), self.radius) = cv2.minEnclosingCircle(c)
-            M = cv2.moments(c)
-            center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-            X = int(self.box_x)
-            Y = int(self.box_y)
-            error_Y = abs(240 - Y)
-            error_X = abs(320 - X)
-
-            if Y < 240 - CVThread.tor:
-                # error_Y*CVThread.aspd
-                robot.lookUp()
-            elif Y > 240 + CVThread.tor:
-                robot.lookDown()
-            else:
-                Y_LOCK = 1
 
-            if X < 320 - CVThread.tor:
-                robot.lookLeft()
-            elif X > 320 + CVThread.tor:
-                robot.lookRight()
-            else:
-                X_LOCK = 1
 
-            if X_LOCK == 1 and Y_LOCK == 1:
+    def applyColor(self, target):
+        if target is not None:
+            self.findColorDetection = 1
+            (self.box_x, self.box_y, self.radius) = target[:3]
+            self.colorBlobs = target.blobs
+            # the gimbal controller steers the head at its own rate
+            capturedAt = self.resultCapturedAt if self.resultCapturedAt is not None else time.time()
+            self.gimbal.update(self.box_x, self.box_y, capturedAt)
+            X_LOCK = abs(self.box_x - CVThread.videoW / 2) <= CVThread.tor
+            Y_LOCK = abs(self.box_y - CVThread.videoH / 2) <= CVThread.tor
+            if X_LOCK and Y_LOCK:
                 robot.lightCtrl('red', 0)
             else:
                 robot.lightCtrl('blue', 0)
 
         else:
             self.findColorDetection = 0
-        self.pause()
+            self.colorBlobs = ()
+            self.gimbal.lost()
 
 
-    def faceDetectCV(self, frame_image):
-        grayGen = cv2.cvtColor(frame_image, cv2.COLOR_BGR2GRAY)
-        self.faces = faceCascade.detectMultiScale(
-                grayGen,       
-                scaleFactor=1.2,
-                minNeighbors=5,       
-                minSize=(20, 20)
-            )
+    def gimbalStep(self, axis, direction):
+        if axis == 'UD' and direction > 0:
+            robot.lookDown()
+        elif axis == 'UD':
+            robot.lookUp()
+        elif direction > 0:
+            robot.lookRight()
+        else:
+            robot.lookLeft()
+
+
+    def applyFaces(self, result):
+        (self.faces, detected) = result
+        self.faceUpdateRate.tick()
+        if detected:
+            self.faceDetectRate.tick()
         if len(self.faces):
             robot.lightCtrl('red', 0)
         else:
             robot.lightCtrl('blue', 0)
-        self.pause()
+
+
+    def stats(self):
+        return {
+            'mode': self.CVMode,
+            'face_detect_fps': round(self.faceDetectRate.rate(), 1),
+            'face_update_fps': round(self.faceUpdateRate.rate(), 1),
+            'color_blobs': len(self.colorBlobs),
+            'line_angle': self.lineScan.angle if self.lineScan else None,
+            'line_curvature': self.lineScan.curvature if self.lineScan else None,
+            'gimbal': self.gimbal.stats(),
+        }
+
+
+    def faceParams(self):
+        return (faceDetectInterval, faceDistance)
+
+    def colorParams(self):
+        return (colorLower.tolist(), colorUpper.tolist(), colorStep, colorMinArea)
+
+    def lineParams(self):
+        return (lineScanRows, linePos_1, linePos_2, lineColorSet, bool(frameRender))
+
+    def motionParams(self):
+        return (motionMinArea, motionSensitivity, motionWidth)
+
+
+    def stopLine(self):
+        time.sleep(0.05)
+        robot.stopLR()
+        time.sleep(0.05)
+        robot.stopFB()
+
+
+    def detectParams(self, modes):
+        return dict((mode, getattr(self, CVThread.HANDLERS[mode].params)()) for mode in modes)
+
+
+    def applyResults(self, results, seq=None, capturedAt=None):
+        self.resultCapturedAt = capturedAt
+        for mode in cv_modes.ordered(results):
+            getattr(self, CVThread.HANDLERS[mode].apply)(results[mode])
+        if seq is not None:
+            self.publishResults(results, seq, capturedAt)
+
+
+    def publishResults(self, results, seq, capturedAt):
+        # one JSON record per processed frame, tagged with the sequence number
+        # of the streamed frame it belongs to; serialized once for all clients
+        detections = cv_modes.records(results)
+        if 'findlineCV' in detections:
+            detections['findlineCV']['command'] = self.CVCommand
+        record = {
+            'seq': seq,
+            'time': capturedAt,
+            'size': [CVThread.videoW, CVThread.videoH],
+            'modes': detections,
+        }
+        Camera.detections.publish(json.dumps(record, separators=(',', ':')), capturedAt, seq)
+
+
+    def submitFrame(self, pool, modes, lease, capturedAt, seq=None):
+        # process execution: detection runs in a worker, the results are
+        # applied (robot commands, overlay state) back in this process
+        label = self.CVMode
+        startTime = time.time()
+        if capturedAt is not None:
+            pipeline_stats.record('cv_wait', startTime - capturedAt, label)
+
+        def done(results, error):
+            if error is not None:
+                print(f"Error in CV worker: {error}")
+            elif self.CVModes == modes and (capturedAt or 0) >= self.appliedAt:
+                # with several workers results can overtake each other,
+                # an older frame never overwrites a newer result
+                self.appliedAt = capturedAt or 0
+                self.applyResults(results, seq, capturedAt)
+            pipeline_stats.record('cv', time.time() - startTime, label)
+            self.CVThreading = 1 if pool.full(modes) else 0
+
+        self.CVThreading = 1
+        pool.submit(modes, lease, self.detectParams(modes), done)
+        self.CVThreading = 1 if pool.full(modes) else 0
 
 
     def pause(self):
@@ -374,42 +497,56 @@ class CVThread(threading.Thread):
 
     def run(self):
         while 1:
-            if self.CVMode == 'none':
-                pass
-
             self.__flag.wait()
-            if self.CVMode == 'none':
-                robot.stopLR()
-                robot.stopFB()
-                robot.lightCtrl('blue', 0)
+            imgCV, lease, capturedAt, seq = self.takeFrame()
+            modes = self.CVModes
+            label = self.CVMode
+            pool = Camera.cvPool
+            if pool is not None and lease is not None and lease.ring is pool.ring and modes:
+                # the worker process owns the lease from here on
+                self.submitFrame(pool, modes, lease, capturedAt, seq)
                 self.pause()
                 continue
 
-            elif self.CVMode == 'findColor':
-                self.CVThreading = 1
-                self.findColor(self.imgCV)
-                self.CVThreading = 0
-
-            elif self.CVMode == 'findlineCV':
-                self.CVThreading = 1
-                self.findlineCV(self.imgCV)
-                self.CVThreading = 0
-
-            elif self.CVMode == 'watchDog':
-                self.CVThreading = 1
-                self.watchDog(self.imgCV)
-                self.CVThreading = 0
-
-            elif self.CVMode == 'faceDetection':
+            startTime = time.time()
+            if capturedAt is not None and modes:
+                pipeline_stats.record('cv_wait', startTime - capturedAt, label)
+            try:
+                if not modes:
+                    robot.stopLR()
+                    robot.stopFB()
+                    robot.lightCtrl('blue', 0)
+                    self.pause()
+                    continue
+
+                # every active mode sees the same frame and shares its
+                # preprocessed inputs
                 self.CVThreading = 1
-                self.faceDetectCV(self.imgCV)
+                self.applyResults(self.pipeline.run(imgCV, modes, self.detectParams(modes)), seq, capturedAt)
                 self.CVThreading = 0
+                self.pause()
+                pipeline_stats.record('cv', time.time() - startTime, label)
+            finally:
+                if lease is not None:
+                    lease.release()
 
 
 class Camera(BaseCamera):
     video_source = 0
-    modeSelect = 'none'
+    modeSelect = 'none'  # active CV modes joined with '+', or 'none'
+    parsedLabel = 'none'
+    parsedModes = ()
     CVMode = 'run'
+    cvt = None
+    ring = None  # FrameRing the sensor is captured into
+    RING_SLOTS = 4  # writer + encoder + CV thread + one spare
+    # 'thread' runs CV in the CV thread, 'process' in cv_workers processes
+    cvExecution = os.environ.get('CV_EXECUTION', 'thread')
+    cvPool = None
+    recorder = None  # clip_recorder.ClipRecorder, created when watchDog first runs
+    overlay = None  # preallocated buffer for overlays on a frame the CV thread reads
+    lease = None  # ring lease of the frame being encoded
+    detections = FrameBroadcast()  # JSON detection record per CV result, by frame seq
 
     def __init__(self):
         if os.environ.get('OPENCV_CAMERA_SOURCE'):
@@ -418,9 +555,9 @@ class Camera(BaseCamera):
 
     # ... (der Rest der Klasse bleibt unverÃ¤ndert) ...
     def robotStop(self):
-        robot.robotCtrl.moveStart(speedMove, 'no', 'no')
+        robot.stopFB()
         time.sleep(0.1)
-        robot.robotCtrl.moveStart(speedMove, 'no', 'no')
+        robot.stopLR()
 
     def colorFindSet(self, invarH, invarS, invarV):
         global colorUpper, colorLower
@@ -447,7 +584,7 @@ class Camera(BaseCamera):
         print(colorLower)
 
     def modeSet(self, invar):
-        Camera.modeSelect = invar
+        Camera.set_modes(*invar.split('+'))
 
     def upperIP(self, invar):
         global upperGlobalIP
@@ -473,14 +610,156 @@ class Camera(BaseCamera):
         global frameRender
         frameRender = invar
 
+    def motionSet(self, sensitivity=None, minArea=None, hold=None):
+        global motionSensitivity, motionMinArea, motionHold
+        if sensitivity is not None:
+            motionSensitivity = int(sensitivity)
+        if minArea is not None:
+            motionMinArea = int(minArea)
+        if hold is not None:
+            motionHold = float(hold)
+
+    def lineScanSet(self, rows):
+        global lineScanRows
+        lineScanRows = tuple(int(row) for row in rows)
+
     def errorSet(self, invar):
         global findLineError
         findLineError = invar
 
+    def faceIntervalSet(self, invar):
+        global faceDetectInterval
+        faceDetectInterval = max(1, int(invar))
+
+    def faceDistanceSet(self, invar):
+        global faceDistance
+        faceDistance = float(invar) if invar else None
+
     @staticmethod
     def set_video_source(source):
         Camera.video_source = source
 
+    @staticmethod
+    def cv_mode():
+        return Camera.modeSelect
+
+    @staticmethod
+    def active_modes():
+        """The CV modes in modeSelect; 'watchDog+faceDetection' runs both."""
+        label = Camera.modeSelect
+        if label != Camera.parsedLabel:
+            Camera.parsedModes = cv_modes.ordered(label.split('+'))
+            Camera.parsedLabel = label
+        return Camera.parsedModes
+
+    @staticmethod
+    def set_modes(*modes):
+        """Run exactly these CV modes (none switches CV off)."""
+        old = Camera.active_modes()
+        modes = cv_modes.ordered(modes)
+        Camera.modeSelect = '+'.join(modes) or 'none'
+        cvt = Camera.cvt
+        for mode in old:
+            stop = CVThread.HANDLERS[mode].stop
+            if mode not in modes and stop and cvt is not None:
+                getattr(cvt, stop)()
+        if modes:
+            Camera.ensure_running()
+
+    @staticmethod
+    def switch_mode(mode, on):
+        """Switch one CV mode on or off, leaving the others running."""
+        modes = [m for m in Camera.active_modes() if m != mode]
+        if on:
+            modes.append(mode)
+        Camera.set_modes(*modes)
+
+    @staticmethod
+    def needs_capture():
+        # CV modes keep capturing (but not encoding) without viewers
+        return bool(Camera.active_modes())
+
+    @staticmethod
+    def frame_ring(shape):
+        shared = Camera.cvExecution == 'process'
+        if Camera.ring is None or not Camera.ring.fits(shape, shared=shared):
+            old = Camera.ring
+            if shared:
+                # every worker can hold a slot while it detects
+                workers = cv_workers.workerCount()
+                Camera.ring = FrameRing(Camera.RING_SLOTS + workers, shape, shared=True)
+                if Camera.cvPool is not None:
+                    Camera.cvPool.shutdown()
+                Camera.cvPool = cv_workers.CVWorkerPool(Camera.ring, faceCascadePath, workers)
+            else:
+                Camera.ring = FrameRing(Camera.RING_SLOTS, shape)
+            if old is not None:
+                # the workers that mapped it are gone, free its shared memory
+                old.close()
+        return Camera.ring
+
+    @staticmethod
+    def prepare(cvt, lease, capturedAt):
+        # hand the slot to the CV thread if it is free; returns the clean
+        # image, the overlays are drawn by annotate() if a profile wants them
+        img = lease.array
+        Camera.lease = lease
+        modes = Camera.active_modes()
+        Camera.record_clips('watchDog' in modes)
+        if not modes:
+            cvt.pause()
+            return img
+
+        if not cvt.CVThreading:
+            # the camera thread publishes this image right after prepare(),
+            # under the next sequence number
+            seq = Camera.raw.latest.seq + 1
+            cvt.mode(modes, img, lease.ring.lease(lease.index), capturedAt, seq)
+            cvt.resume()
+        return img
+
+    @staticmethod
+    def annotate(img):
+        modes = Camera.active_modes()
+        if not modes or Camera.cvt is None:
+            return img
+        drawStart = time.time()
+        lease = Camera.lease
+        if lease is not None and lease.array is img and lease.ring.readers(lease.index) > 1:
+            # somebody else reads this slot, don't draw over their pixels
+            if Camera.overlay is None or Camera.overlay.shape != img.shape:
+                Camera.overlay = np.empty_like(img)
+            np.copyto(Camera.overlay, img)
+            img = Camera.overlay
+        try:
+            img = Camera.cvt.elementDraw(img)
+        except Exception as e:
+            print(f"Error in elementDraw: {e}")
+        pipeline_stats.record('draw', time.time() - drawStart, Camera.modeSelect)
+        return img
+
+    @staticmethod
+    def record_clips(watching):
+        # watchDog keeps a pre-roll of encoded frames and saves clips on motion;
+        # the clean profile, so no viewers means no annotating just for the clips
+        if Camera.recorder is None:
+            if not watching:
+                return
+            Camera.recorder = clip_recorder.ClipRecorder(Camera, get_profile(quality=75, overlay=False))
+        if Camera.recorder.armed != watching:
+            if watching:
+                Camera.recorder.arm()
+            else:
+                Camera.recorder.disarm()
+
+    @staticmethod
+    def cv_thread():
+        # one CV thread for the whole process, it survives camera restarts
+        if Camera.cvt is None:
+            Camera.cvt = CVThread()
+            Camera.cvt.start()
+        return Camera.cvt
+
     # Veraltete frames() Methode wird ersetzt
     # @staticmethod
     # def frames():
@@ -499,31 +778,38 @@ class Camera(BaseCamera):
             print("INFO: picamera2 started.")
             
             # CV-Thread initialization and start
-            cvt = CVThread()
-            cvt.start()
-
-            while True:
-                # Capture image as NumPy array
-                img = picam2.capture_array()
-
-                if Camera.modeSelect == 'none':
-                    cvt.pause()
-                else:
-                    if not cvt.CVThreading:
-                        cvt.mode(Camera.modeSelect, img)
-                        cvt.resume()
+            cvt = Camera.cv_thread()
+
+            try:
+                while True:
+                    # Copy the sensor buffer into a free ring slot instead of
+                    # allocating a new array per frame like capture_array()
+                    slot = None
+                    capturedAt = time.time()
+                    request = picam2.capture_request()
                     try:
-                        img = cvt.elementDraw(img)
-                    except Exception as e:
-                        print(f"Error in elementDraw: {e}")
-                        pass
-
-                # Encode image as JPEG and output
-                try:
-                    yield cv2.imencode('.jpg', img)[1].tobytes()
-                except Exception as e:
-                    print(f"Error encoding frame: {e}")
-                    pass
+                        with MappedArray(request, 'main') as m:
+                            ring = Camera.frame_ring(m.array.shape)
+                            slot = ring.acquire()
+                            if slot is not None:
+                                np.copyto(ring.buffers[slot], m.array)
+                    finally:
+                        request.release()
+                    if slot is None:
+                        continue
+                    pipeline_stats.record('capture', time.time() - capturedAt, Camera.modeSelect)
+
+                    # Hand the image over for per-profile JPEG encoding
+                    lease = ring.commit(slot)
+                    try:
+                        yield Camera.prepare(cvt, lease, capturedAt)
+                    finally:
+                        lease.release()
+            finally:
+                # release the sensor so that a restarted camera thread can open it
+                picam2.stop()
+                picam2.close()
+                print("INFO: picamera2 stopped.")
         else:
             # OpenCV camera fallback for Windows/development
             camera = cv2.VideoCapture(Camera.video_source)
@@ -534,47 +820,49 @@ class Camera(BaseCamera):
                     dummy_frame = np.zeros((480, 640, 3), dtype=np.uint8)
                     cv2.putText(dummy_frame, "No Camera Available", (150, 240), 
                                cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-                    yield cv2.imencode('.jpg', dummy_frame)[1].tobytes()
+                    yield dummy_frame
                     time.sleep(0.1)
             
             # CV-Thread initialization and start
-            cvt = CVThread()
-            cvt.start()
+            cvt = Camera.cv_thread()
             
+            ring = Camera.frame_ring((480, 640, 3))
+            img = None
             try:
                 while True:
-                    # Read frame from camera
-                    success, img = camera.read()
+                    # Read frame from camera, reusing the previous buffer
+                    capturedAt = time.time()
+                    success, img = camera.read(img)
                     if not success:
                         break
                     else:
-                        # Resize to match expected dimensions
-                        img = cv2.resize(img, (640, 480))
-                        
-                        if Camera.modeSelect == 'none':
-                            cvt.pause()
-                        else:
-                            if not cvt.CVThreading:
-                                cvt.mode(Camera.modeSelect, img)
-                                cvt.resume()
-                            try:
-                                img = cvt.elementDraw(img)
-                            except Exception as e:
-                                print(f"Error in elementDraw: {e}")
-                                pass
-
-                        # Encode image as JPEG and output
+                        slot = ring.acquire()
+                        if slot is None:
+                            continue
+                        # Resize to match expected dimensions, straight into the slot
+                        cv2.resize(img, (640, 480), dst=ring.buffers[slot])
+                        pipeline_stats.record('capture', time.time() - capturedAt, Camera.modeSelect)
+
+                        # Hand the image over for per-profile JPEG encoding
+                        lease = ring.commit(slot)
                         try:
-                            yield cv2.imencode('.jpg', img)[1].tobytes()
-                        except Exception as e:
-                            print(f"Error encoding frame: {e}")
-                            pass
+                            yield Camera.prepare(cvt, lease, capturedAt)
+                        finally:
+                            lease.release()
             finally:
                 camera.release()
     # ############ END CAMERA METHOD ################
 
 
 # ... (der Rest der Datei bleibt unverÃ¤ndert) ...
+# web UI command -> (CV mode, on); switches that mode next to the others
+CV_COMMANDS = {
+    'faceDetection': ('faceDetection', True),
+    'faceDetectionOff': ('faceDetection', False),
+    'trackLine': ('findlineCV', True),
+    'trackLineOff': ('findlineCV', False),
+}
+
 def commandAct(act, inputA):
     global speedMove
     if act == 'forward':
@@ -618,16 +906,8 @@ def commandAct(act, inputA):
         robot.steadyMode()
 
     # openCV ctrl.
-    elif act == 'faceDetection':
-        Camera.modeSelect = 'faceDetection'
-    elif act == 'faceDetectionOff':
-        Camera.modeSelect = 'none'
-    elif 'trackLine' == act:
-        Camera.modeSelect = 'findlineCV'
-        Camera.CVMode = 'run'
-    elif 'trackLineOff' == act:
-        Camera.modeSelect = 'none'
-        time.sleep(0.05)
-        robot.stopLR()
-        time.sleep(0.05)
-        robot.stopFB()
+    elif act in CV_COMMANDS:
+        mode, on = CV_COMMANDS[act]
+        if act == 'trackLine':
+            Camera.CVMode = 'run'
+        Camera.switch_mode(mode, on)
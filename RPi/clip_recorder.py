@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# File name   : clip_recorder.py
+# Description : Save motion clips (MJPEG AVI) with a pre-roll of encoded frames.
+#
+# The recorder listens to one encoded stream profile, so the frames it keeps
+# are the JPEGs the camera thread made anyway. The last `preroll` seconds
+# stay in memory; a motion trigger hands them plus everything up to
+# `postroll` seconds after the last trigger to a writer thread. The camera
+# thread only appends to a deque and a bounded queue, it never waits for
+# the SD card: if the writer falls behind, frames are dropped and counted.
+import collections
+import os
+import queue
+import struct
+import threading
+import time
+
+thisPath = os.path.dirname(os.path.realpath(__file__))
+CLIP_DIR = os.environ.get('CLIP_DIR', os.path.join(thisPath, 'clips'))
+CLIP_MAX_BYTES = int(os.environ.get('CLIP_MAX_MB', 512)) * 1024 * 1024
+CLIP_MAX_COUNT = 100
+PREROLL = 5.0  # seconds kept in memory before a trigger
+POSTROLL = 5.0  # seconds recorded after the last trigger
+MAX_LENGTH = 60.0  # a clip is closed after this long even if motion goes on
+QUEUE_FRAMES = 300  # frames the writer may fall behind before frames are dropped
+
+
+class MJPEGWriter(object):
+    """Minimal AVI (RIFF) writer that stores the JPEG bytes as they are.
+
+    cv2.VideoWriter would decode and re-encode every frame; here a frame is
+    one '00dc' chunk. The header is written with placeholders and rewritten
+    on close, when the frame count and the real frame rate are known.
+    """
+    HEADER_SIZE = 224  # RIFF..movi, fixed for one MJPEG video stream
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.file = open(path, 'wb')
+        self.file.write(b'\0' * self.HEADER_SIZE)
+        self.index = []
+        self.first = None
+        self.last = None
+        self.largest = 0
+
+    def add(self, data, timestamp):
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        # offsets in idx1 count from the 'movi' fourcc
+        self.index.append((self.file.tell() - (self.HEADER_SIZE - 4), len(data)))
+        self.largest = max(self.largest, len(data))
+        self.file.write(b'00dc' + struct.pack('<I', len(data)))
+        self.file.write(data)
+        if len(data) % 2:
+            self.file.write(b'\0')
+
+    def close(self):
+        f = self.file
+        moviEnd = f.tell()
+        f.write(b'idx1' + struct.pack('<I', 16 * len(self.index)))
+        f.write(b''.join(struct.pack('<4sIII', b'00dc', 0x10, offset, size)
+                         for offset, size in self.index))
+        fileEnd = f.tell()
+
+        frames = len(self.index)
+        duration = (self.last - self.first) if frames > 1 else 0
+        fps = (frames - 1) / duration if duration > 0 else 10.0
+        usPerFrame = int(round(1000000 / fps))
+        avih = struct.pack('<14I', usPerFrame, int(self.largest * fps), 0, 0x10, frames, 0, 1,
+                           self.largest, self.width, self.height, 0, 0, 0, 0)
+        strh = struct.pack('<4s4sIHHIIIIIIIIhhhh', b'vids', b'MJPG', 0, 0, 0, 0,
+                           usPerFrame, 1000000, 0, frames, self.largest, 0xFFFFFFFF, 0,
+                           0, 0, self.width, self.height)
+        strf = struct.pack('<IiiHH4sIiiII', 40, self.width, self.height, 1, 24, b'MJPG',
+                           self.width * self.height * 3, 0, 0, 0, 0)
+        strl = b'strl' + b'strh' + struct.pack('<I', len(strh)) + strh + b'strf' + struct.pack('<I', len(strf)) + strf
+        hdrl = (b'hdrl' + b'avih' + struct.pack('<I', len(avih)) + avih
+                + b'LIST' + struct.pack('<I', len(strl)) + strl)
+        header = (b'RIFF' + struct.pack('<I', fileEnd - 8) + b'AVI '
+                  + b'LIST' + struct.pack('<I', len(hdrl)) + hdrl
+                  + b'LIST' + struct.pack('<I', moviEnd - (self.HEADER_SIZE - 4)) + b'movi')
+        assert len(header) == self.HEADER_SIZE
+        f.seek(0)
+        f.write(header)
+        f.close()
+        return frames
+
+
+def list_clips(directory=CLIP_DIR):
+    """Saved clips, newest first."""
+    clips = []
+    if not os.path.isdir(directory):
+        return clips
+    for name in os.listdir(directory):
+        if not name.endswith('.avi'):
+            continue
+        path = os.path.join(directory, name)
+        st = os.stat(path)
+        clips.append({'name': name, 'bytes': st.st_size, 'time': st.st_mtime})
+    clips.sort(key=lambda clip: clip['time'], reverse=True)
+    return clips
+
+
+def enforce_retention(directory=CLIP_DIR, maxBytes=CLIP_MAX_BYTES, maxCount=CLIP_MAX_COUNT):
+    """Delete the oldest clips until both caps hold; the newest clip stays."""
+    clips = list_clips(directory)
+    total = sum(clip['bytes'] for clip in clips)
+    while len(clips) > 1 and (total > maxBytes or len(clips) > maxCount):
+        clip = clips.pop()
+        try:
+            os.remove(os.path.join(directory, clip['name']))
+        except OSError as e:
+            print(f"Could not delete clip {clip['name']}: {e}")
+        total -= clip['bytes']
+
+
+class ClipRecorder(object):
+    """Keeps a pre-roll of encoded frames and writes clips on trigger()."""
+    def __init__(self, camera, profile, directory=CLIP_DIR, preroll=PREROLL, postroll=POSTROLL):
+        self.camera = camera
+        self.profile = profile
+        self.directory = directory
+        self.preroll = preroll
+        self.postroll = postroll
+        self.armed = False
+        self.lock = threading.Lock()
+        self.frames = collections.deque()
+        self.recording = False
+        self.started = 0.0
+        self.until = 0.0
+        self.queue = queue.Queue()
+        self.writer = None
+        self.counters = {'clips': 0, 'frames': 0, 'dropped': 0}
+
+    def arm(self):
+        """Subscribe to the profile and start filling the pre-roll."""
+        if self.armed:
+            return
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+        self.armed = True
+        self.camera.subscribe(self.profile)
+        self.camera.broadcasts[self.profile].add_listener(self.on_frame)
+
+    def disarm(self):
+        if not self.armed:
+            return
+        self.armed = False
+        self.camera.broadcasts[self.profile].remove_listener(self.on_frame)
+        self.camera.unsubscribe(self.profile)
+        with self.lock:
+            self.frames.clear()
+            if self.recording:
+                self.recording = False
+                self.put(None)
+
+    def trigger(self, now=None):
+        """Motion seen: start a clip with the pre-roll, or extend the current one."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not self.armed:
+                return
+            if not self.recording:
+                self.recording = True
+                self.started = now
+                name = time.strftime('motion-%Y%m%d-%H%M%S.avi', time.localtime(now))
+                self.put(name)
+                for frame in self.frames:
+                    self.put(frame)
+            self.until = min(now + self.postroll, self.started + MAX_LENGTH)
+
+    def on_frame(self, frame):
+        # runs in the camera thread for every encoded frame of the profile
+        with self.lock:
+            frames = self.frames
+            frames.append(frame)
+            while frame.timestamp - frames[0].timestamp > self.preroll:
+                frames.popleft()
+            if self.recording:
+                if frame.timestamp > self.until:
+                    self.recording = False
+                    self.put(None)
+                else:
+                    self.put(frame)
+
+    def put(self, item):
+        # frames may be dropped, the start/end markers of a clip may not
+        if isinstance(item, tuple) and self.queue.qsize() >= QUEUE_FRAMES:
+            self.counters['dropped'] += 1
+            return
+        self.queue.put(item)
+
+    def write_loop(self):
+        writer = None
+        while True:
+            item = self.queue.get()
+            try:
+                if isinstance(item, str):
+                    if writer is not None:
+                        writer.close()
+                    os.makedirs(self.directory, exist_ok=True)
+                    writer = MJPEGWriter(os.path.join(self.directory, item),
+                                         self.profile.width, self.profile.height)
+                    print(f"Recording clip {item}")
+                elif item is None:
+                    if writer is not None:
+                        frames = writer.close()
+                        writer = None
+                        self.counters['clips'] += 1
+                        print(f"Clip saved, {frames} frames")
+                        enforce_retention(self.directory)
+                elif writer is not None:
+                    writer.add(item.data, item.timestamp)
+                    self.counters['frames'] += 1
+            except OSError as e:
+                print(f"Error writing clip: {e}")
+                writer = None
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['armed'] = self.armed
+        stats['recording'] = self.recording
+        stats['queued'] = self.queue.qsize()
+        stats['preroll_frames'] = len(self.frames)
+        return stats
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# File name   : cv_detect.py
+# Description : Detection part of the CV modes, free of robot/camera state.
+#
+# Everything here only looks at pixels and returns small tuples, so the same
+# code runs in the CV thread and in the CV worker processes (cv_workers.py).
+import collections
+import math
+import cv2
+import numpy as np
+import imutils
+
+FACE_WIDTH = 0.15     # metres, an adult face seen from the front
+CASCADE_WINDOW = 24   # detection window of haarcascade_frontalface_default
+CAMERA_FOV = 62.2     # horizontal field of view of the Pi camera v2, degrees
+
+
+def faceMinSize(distance, frameWidth, fov=CAMERA_FOV):
+    """Width in pixels of a face `distance` metres away from the camera."""
+    focal = frameWidth / (2 * math.tan(math.radians(fov) / 2))
+    return focal * FACE_WIDTH / distance
+
+
+def faceScale(distance, frameWidth, fov=CAMERA_FOV):
+    """Downscale at which a face at `distance` still fills the cascade window.
+
+    Faces closer than `distance` are larger and are found as well; anything
+    further away may be missed. Never upscales.
+    """
+    return min(1.0, CASCADE_WINDOW / faceMinSize(distance, frameWidth, fov))
+
+
+def detectFaces(frame_image, cascade, scale=1.0):
+    """Return the face boxes as a tuple of (x, y, w, h)."""
+    return detectFacesGray(cv2.cvtColor(frame_image, cv2.COLOR_BGR2GRAY), cascade, scale)
+
+
+def detectFacesGray(gray, cascade, scale=1.0):
+    """Run the cascade on gray shrunk by `scale`; boxes are in gray's coordinates."""
+    if scale < 1.0:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        small = gray
+    faces = cascade.detectMultiScale(
+            small,
+            scaleFactor=1.2,
+            minNeighbors=5,
+            minSize=(20, 20)
+        )
+    if scale < 1.0:
+        return tuple(tuple(int(round(v / scale)) for v in face) for face in faces)
+    return tuple(tuple(int(v) for v in face) for face in faces)
+
+
+class LazyCascade(object):
+    """Load the cascade file the first time a detection needs it.
+
+    Most sessions never switch face detection on, so neither the CV thread
+    nor a worker process should pay for parsing the XML up front.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.cascade = None
+
+    def detectMultiScale(self, *args, **kwargs):
+        if self.cascade is None:
+            self.cascade = cv2.CascadeClassifier(self.path)
+            if self.cascade.empty():
+                raise IOError('could not load face cascade %s' % self.path)
+        return self.cascade.detectMultiScale(*args, **kwargs)
+
+
+class FaceTracker(object):
+    """Face mode that runs the cascade only every `interval` frames.
+
+    In between, every box is followed by template matching inside a window
+    around its last position, which costs a fraction of a cascade pass. A
+    match score below `minScore` counts as confidence loss: the box is
+    dropped and the next frame runs the full detection again.
+
+    Detection runs on a copy scaled so that faces up to `distance` metres
+    away still fill the cascade window (see faceScale); None keeps the
+    native resolution.
+    """
+    def __init__(self, interval=10, distance=None, minScore=0.6, margin=0.5):
+        self.interval = interval
+        self.distance = distance
+        self.minScore = minScore
+        self.margin = margin
+        self.faces = ()
+        self.templates = []
+        self.sinceDetect = 0
+        self.lost = False
+
+    def update(self, frame_image, cascade):
+        """Return (faces, detected): the current boxes and whether the cascade ran."""
+        if frame_image.ndim == 2:
+            gray = frame_image
+        else:
+            gray = cv2.cvtColor(frame_image, cv2.COLOR_BGR2GRAY)
+        self.sinceDetect += 1
+        if self.lost or not self.faces or self.sinceDetect >= self.interval:
+            return self.detect(gray, cascade), True
+
+        faces = []
+        templates = []
+        for (x, y, w, h), template in zip(self.faces, self.templates):
+            box = self.track(gray, (x, y, w, h), template)
+            if box is None:
+                self.lost = True
+                continue
+            faces.append(box)
+            templates.append(template)
+        if not faces:
+            # every track is gone, don't wait for the next frame
+            return self.detect(gray, cascade), True
+        self.faces = tuple(faces)
+        self.templates = templates
+        return self.faces, False
+
+    def detect(self, gray, cascade):
+        scale = faceScale(self.distance, gray.shape[1]) if self.distance else 1.0
+        self.faces = detectFacesGray(gray, cascade, scale)
+        self.templates = [gray[y:y+h, x:x+w].copy() for (x, y, w, h) in self.faces]
+        self.sinceDetect = 0
+        self.lost = False
+        return self.faces
+
+    def track(self, gray, box, template):
+        x, y, w, h = box
+        dx = int(w * self.margin)
+        dy = int(h * self.margin)
+        x0 = max(x - dx, 0)
+        y0 = max(y - dy, 0)
+        x1 = min(x + w + dx, gray.shape[1])
+        y1 = min(y + h + dy, gray.shape[0])
+        if x1 - x0 < w or y1 - y0 < h:
+            return None
+        scores = cv2.matchTemplate(gray[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED)
+        minVal, score, minLoc, loc = cv2.minMaxLoc(scores)
+        if score < self.minScore:
+            return None
+        return (x0 + loc[0], y0 + loc[1], w, h)
+
+
+LINE_ERODE = 6  # the old full-frame path eroded 6 times with a 3x3 kernel
+
+LineScan = collections.namedtuple('LineScan',
+    ['left1', 'right1', 'left2', 'right2', 'center', 'points', 'angle', 'curvature', 'bands'])
+
+
+def scanRows(rows, height, erode=LINE_ERODE):
+    """Clip the scanlines so their band stays inside the frame."""
+    return tuple(min(max(int(row), erode), height - erode - 1) for row in rows)
+
+
+def lineBands(frame_image, rows, erode=LINE_ERODE):
+    """Otsu-threshold only the bands of 2*erode+1 rows around each scanline.
+
+    Returns an array of shape (len(rows), 2*erode+1, width).
+    """
+    bands = np.concatenate([frame_image[row-erode:row+erode+1] for row in rows])
+    if bands.ndim == 3:
+        bands = cv2.cvtColor(bands, cv2.COLOR_BGR2GRAY)
+    retval, bands = cv2.threshold(bands, 0, 255, cv2.THRESH_OTSU)
+    return bands.reshape(len(rows), 2*erode+1, -1)
+
+
+def lineSegments(bands, lineColorSet, erode=LINE_ERODE):
+    """Line segments on the centre row of every band.
+
+    The band is eroded like the full frame used to be (a (2*erode+1)^2
+    square): a column minimum over the band, then a 1-D erosion along the
+    row. The runs of lineColorSet are found for all rows at once from the
+    edges of the padded hit mask. Returns (band index, start, end) arrays,
+    end inclusive.
+    """
+    rows = bands.min(axis=1)
+    rows = cv2.erode(rows, np.ones((1, 2*erode+1), np.uint8))
+    hit = np.zeros((rows.shape[0], rows.shape[1] + 2), np.int8)
+    hit[:, 1:-1] = rows == lineColorSet
+    band, col = np.nonzero(np.diff(hit, axis=1))
+    # every row starts and ends outside a run, so the edges come in pairs
+    return band[0::2], col[0::2], col[1::2] - 1
+
+
+def fitLine(points):
+    """Angle (degrees, positive when the line leans right further ahead) and
+    curvature (1/px at the nearest scanline) through the segment centres.
+
+    Least squares on a handful of points, solved directly: np.polyfit costs
+    more than the whole band analysis.
+    """
+    n = len(points)
+    if n < 2:
+        return None, None
+    y0 = max(p[0] for p in points)
+    # measure y upwards from the nearest scanline, x from its centre
+    ys = [y0 - p[0] for p in points]
+    xs = [p[1] for p in points]
+    sy = float(sum(ys))
+    sx = float(sum(xs))
+    syy = float(sum(y*y for y in ys))
+    sxy = float(sum(x*y for x, y in zip(xs, ys)))
+    det = n*syy - sy*sy
+    if not det:
+        return None, None
+    slope = (n*sxy - sy*sx) / det
+    angle = math.degrees(math.atan(slope))
+    if n < 3:
+        return angle, None
+    # x = a + b*y + c*y^2, curvature at y = 0 is 2c / (1 + b^2)^1.5
+    syyy = float(sum(y**3 for y in ys))
+    syyyy = float(sum(y**4 for y in ys))
+    sxyy = float(sum(x*y*y for x, y in zip(xs, ys)))
+    try:
+        a, b, c = np.linalg.solve([[n, sy, syy], [sy, syy, syyy], [syy, syyy, syyyy]], [sx, sxy, sxyy])
+    except np.linalg.LinAlgError:
+        return angle, None
+    return angle, float(2*c / (1 + b*b) ** 1.5)
+
+
+def scanLine(frame_image, rows, linePos_1, linePos_2, lineColorSet, keepBands=False):
+    """Find the line on a set of scanlines instead of the whole frame.
+
+    On each scanline the widest segment counts. The robot is steered from
+    linePos_1 and linePos_2 as before; center is None if either of them has
+    no segment. All found scanlines give the angle and curvature estimate.
+    """
+    height = frame_image.shape[0]
+    rows = scanRows(sorted(set(rows) | {linePos_1, linePos_2}, reverse=True), height)
+    bands = lineBands(frame_image, rows)
+    band, starts, ends = lineSegments(bands, lineColorSet)
+
+    found = {}
+    widths = ends - starts
+    for i in np.argsort(widths, kind='stable'):
+        # ascending width, so the widest segment of each row is written last
+        found[rows[band[i]]] = (int(ends[i]), int(starts[i]))
+
+    points = tuple((row, (found[row][0] + found[row][1]) // 2) for row in rows if row in found)
+    angle, curvature = fitLine(points)
+    row1, row2 = scanRows((linePos_1, linePos_2), height)
+    if row1 in found and row2 in found:
+        left1, right1 = found[row1]
+        left2, right2 = found[row2]
+        center = int((int((left1+right1)/2) + int((left2+right2)/2))/2)
+    else:
+        left1 = right1 = left2 = right2 = center = None
+    return LineScan(left1, right1, left2, right2, center, points, angle, curvature,
+        (rows, bands) if keepBands else None)
+
+
+ColorTarget = collections.namedtuple('ColorTarget', ['x', 'y', 'radius', 'blobs', 'windowed'])
+
+
+class ColorTracker(object):
+    """findColor mode: search a window around the last target.
+
+    The whole frame is only masked to (re)acquire a target, optionally on
+    every `step`th pixel. Every blob of at least `minArea` stream pixels is
+    reported from the contours of that one mask; the largest one is the
+    target.
+    """
+    def __init__(self, step=2, minArea=100, margin=2.0):
+        self.step = step
+        self.minArea = minArea
+        self.margin = margin
+        self.range = None
+        self.last = None
+
+    def update(self, frame_image, colorLower, colorUpper):
+        """Return a ColorTarget, or None if nothing in range is visible."""
+        colorRange = (np.asarray(colorLower), np.asarray(colorUpper))
+        if self.range is None or not all(np.array_equal(a, b) for a, b in zip(colorRange, self.range)):
+            # a new colour was picked, the old target means nothing
+            self.range = colorRange
+            self.last = None
+
+        if self.last is not None:
+            x, y, radius = self.last
+            reach = int(radius * (1 + self.margin)) + 16
+            target = self.search(frame_image, (int(x) - reach, int(y) - reach, int(x) + reach, int(y) + reach))
+            if target is not None:
+                return target
+        target = self.search(frame_image, None)
+        self.last = None if target is None else target[:3]
+        return target
+
+    def search(self, frame_image, window):
+        height, width = frame_image.shape[:2]
+        if window is None:
+            x0, y0, x1, y1 = 0, 0, width, height
+        else:
+            x0, y0 = max(window[0], 0), max(window[1], 0)
+            x1, y1 = min(window[2], width), min(window[3], height)
+            if x1 <= x0 or y1 <= y0:
+                return None
+        step = self.step
+        small = frame_image[y0:y1:step, x0:x1:step]
+        if small.shape[2] == 4:
+            small = cv2.cvtColor(small, cv2.COLOR_BGRA2BGR)
+        mask = cv2.inRange(cv2.cvtColor(small, cv2.COLOR_BGR2HSV), self.range[0], self.range[1])
+        iterations = max(1, 2 // step)
+        mask = cv2.erode(mask, None, iterations=iterations)
+        mask = cv2.dilate(mask, None, iterations=iterations)
+        cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+        minArea = self.minArea / float(step * step)
+        found = []
+        for c in cnts:
+            area = cv2.contourArea(c)
+            if area >= minArea:
+                found.append((area, c))
+        if not found:
+            return None
+        found.sort(key=lambda item: item[0], reverse=True)
+        blobs = []
+        for area, c in found:
+            bx, by, bw, bh = cv2.boundingRect(c)
+            blobs.append((x0 + bx * step, y0 + by * step, bw * step, bh * step, int(area * step * step)))
+        ((box_x, box_y), radius) = cv2.minEnclosingCircle(found[0][1])
+        target = ColorTarget(x0 + float(box_x) * step, y0 + float(box_y) * step, float(radius) * step,
+            tuple(blobs), window is not None)
+        self.last = target[:3]
+        return target
+
+
+class MotionDetector(object):
+    """Background subtraction on a small grayscale thumbnail for watchDog.
+
+    The background is kept as uint16 in 8.8 fixed point and updated with
+    shifts (weight 1/2**shift for the new frame). `sensitivity` is the gray
+    level difference that counts as motion, `minArea` is in stream pixels.
+    The boxes are returned in stream coordinates.
+    """
+    def __init__(self, minArea=2000, sensitivity=5, width=160, shift=1):
+        self.background = None
+        self.minArea = minArea
+        self.sensitivity = sensitivity
+        self.width = width
+        self.shift = shift
+
+    def update(self, imgInput, frameSize=None):
+        """Return the boxes (x, y, w, h) of moving regions, or None while the
+        background model is being started.
+
+        With frameSize (height, width) imgInput is taken to be the gray
+        thumbnail of a frame that size already.
+        """
+        if frameSize is None:
+            height, width = imgInput.shape[:2]
+            size = (self.width, max(1, int(round(height * self.width / float(width)))))
+            # plain subsampling; the blur below does the averaging on 1/16 of the pixels
+            thumb = cv2.resize(imgInput, size, interpolation=cv2.INTER_NEAREST)
+            if thumb.ndim == 3:
+                thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+        else:
+            height, width = frameSize
+            thumb = imgInput
+            size = (thumb.shape[1], thumb.shape[0])
+        thumb = cv2.GaussianBlur(thumb, (5, 5), 0)
+
+        if self.background is None or self.background.shape != thumb.shape:
+            print("[INFO] starting background model...")
+            self.background = thumb.astype(np.uint16) << 8
+            return None
+
+        background = self.background
+        background -= background >> self.shift
+        background += thumb.astype(np.uint16) << (8 - self.shift)
+        frameDelta = cv2.absdiff(thumb, (background >> 8).astype(np.uint8))
+
+        thresh = cv2.threshold(frameDelta, self.sensitivity, 255, cv2.THRESH_BINARY)[1]
+        thresh = cv2.dilate(thresh, None, iterations=1)
+        cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL,
+            cv2.CHAIN_APPROX_SIMPLE)
+        cnts = imutils.grab_contours(cnts)
+
+        sx = width / float(size[0])
+        sy = height / float(size[1])
+        minArea = self.minArea / (sx * sy)
+        boxes = []
+        for c in cnts:
+            # if the contour is too small, ignore it
+            if cv2.contourArea(c) < minArea:
+                continue
+            (x, y, w, h) = cv2.boundingRect(c)
+            boxes.append((int(x * sx), int(y * sy), int(w * sx), int(h * sy)))
+        return boxes
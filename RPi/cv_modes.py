@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# File name   : cv_modes.py
+# Description : Registry of the CV detectors and the inputs they share per frame.
+#
+# A processor declares which derived images it needs (gray, thumbnail,
+# ...). For every frame the pipeline computes each of them at most once and
+# hands the same FrameInputs to all active processors, so running e.g.
+# watchDog and faceDetection together costs one gray conversion, not two.
+# Like cv_detect, nothing here touches the robot or the camera, so the
+# pipeline runs the same in the CV thread and in cv_workers processes.
+import cv2
+import numpy as np
+import cv_detect
+
+
+class FrameInputs(object):
+    """The derived images of one frame, each computed on first use.
+
+    `needs` is the union of the inputs of all active processors; it lets an
+    input be derived from a shared one (the thumbnail from the full gray
+    frame when that exists anyway) instead of from the raw image.
+    """
+    def __init__(self, img, needs=()):
+        self.img = img
+        self.needs = set(needs)
+        self.cache = {}
+
+    @property
+    def bgr(self):
+        return self.img
+
+    @property
+    def gray(self):
+        gray = self.cache.get('gray')
+        if gray is None:
+            gray = self.img if self.img.ndim == 2 else cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+            self.cache['gray'] = gray
+        return gray
+
+    def thumb(self, width):
+        """Gray image `width` pixels wide, plain subsampling."""
+        key = ('thumb', width)
+        thumb = self.cache.get(key)
+        if thumb is None:
+            height = max(1, int(round(self.img.shape[0] * width / float(self.img.shape[1]))))
+            if 'gray' in self.needs or 'gray' in self.cache:
+                thumb = cv2.resize(self.gray, (width, height), interpolation=cv2.INTER_NEAREST)
+            else:
+                thumb = cv2.resize(self.img, (width, height), interpolation=cv2.INTER_NEAREST)
+                if thumb.ndim == 3:
+                    thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+            self.cache[key] = thumb
+        return thumb
+
+    def rows(self):
+        """The cheapest image to cut scanline bands from: gray if it exists."""
+        if 'gray' in self.needs or 'gray' in self.cache:
+            return self.gray
+        return self.img
+
+
+class Processor(object):
+    """A detector plus the per-frame inputs it reads."""
+    name = None
+    inputs = ()
+    stateful = False  # keeps state between frames, so it sticks to one worker
+
+    def __init__(self, cascadePath):
+        pass
+
+    def detect(self, inputs, params):
+        raise NotImplementedError
+
+    @staticmethod
+    def record(result):
+        """The result as plain lists and numbers for the detection feed."""
+        raise NotImplementedError
+
+
+class FaceProcessor(Processor):
+    name = 'faceDetection'
+    inputs = ('gray',)
+    stateful = True
+
+    def __init__(self, cascadePath):
+        self.cascade = cv_detect.LazyCascade(cascadePath)
+        self.tracker = cv_detect.FaceTracker()
+
+    def detect(self, inputs, params):
+        self.tracker.interval, self.tracker.distance = params
+        return self.tracker.update(inputs.gray, self.cascade)
+
+    @staticmethod
+    def record(result):
+        faces, detected = result
+        return {'faces': [[int(v) for v in box] for box in faces], 'detected': detected}
+
+
+class ColorProcessor(Processor):
+    name = 'findColor'
+    inputs = ('bgr',)
+    stateful = True
+
+    def __init__(self, cascadePath):
+        self.tracker = cv_detect.ColorTracker()
+
+    def detect(self, inputs, params):
+        colorLower, colorUpper, self.tracker.step, self.tracker.minArea = params
+        return self.tracker.update(inputs.bgr, np.array(colorLower), np.array(colorUpper))
+
+    @staticmethod
+    def record(target):
+        if target is None:
+            return {'target': None, 'blobs': []}
+        return {'target': [round(target.x, 1), round(target.y, 1), round(target.radius, 1)],
+                'blobs': [list(blob) for blob in target.blobs]}
+
+
+class LineProcessor(Processor):
+    name = 'findlineCV'
+    inputs = ('rows',)
+
+    def detect(self, inputs, params):
+        return cv_detect.scanLine(inputs.rows(), *params)
+
+    @staticmethod
+    def record(scan):
+        return {'center': scan.center,
+                'edges': None if scan.center is None else list(scan[:4]),
+                'points': [[int(row), int(x)] for row, x in scan.points],
+                'angle': None if scan.angle is None else round(scan.angle, 2),
+                'curvature': None if scan.curvature is None else round(scan.curvature, 6)}
+
+
+class MotionProcessor(Processor):
+    name = 'watchDog'
+    inputs = ('thumb',)
+    stateful = True
+
+    def __init__(self, cascadePath):
+        self.motion = cv_detect.MotionDetector()
+
+    def detect(self, inputs, params):
+        self.motion.minArea, self.motion.sensitivity, self.motion.width = params
+        return self.motion.update(inputs.thumb(self.motion.width), inputs.img.shape[:2])
+
+    @staticmethod
+    def record(boxes):
+        # None while the background model starts
+        return {'boxes': [list(box) for box in boxes or ()]}
+
+
+# in the order they run on a frame and are drawn; the line view may replace
+# the frame with its binarized bands, so it comes first
+PROCESSORS = (LineProcessor, FaceProcessor, ColorProcessor, MotionProcessor)
+MODES = tuple(cls.name for cls in PROCESSORS)
+STATEFUL_MODES = tuple(cls.name for cls in PROCESSORS if cls.stateful)
+PROCESSOR = dict((cls.name, cls) for cls in PROCESSORS)
+
+
+def ordered(modes):
+    """Known modes out of `modes`, without duplicates, in registry order."""
+    return tuple(mode for mode in MODES if mode in modes)
+
+
+class Pipeline(object):
+    """One instance of every processor, for one process."""
+    def __init__(self, cascadePath):
+        self.processors = dict((cls.name, cls(cascadePath)) for cls in PROCESSORS)
+
+    def run(self, img, modes, params):
+        """Run the processors of `modes` on img; returns {mode: result}."""
+        needs = set()
+        for mode in modes:
+            needs.update(self.processors[mode].inputs)
+        inputs = FrameInputs(img, needs)
+        return dict((mode, self.processors[mode].detect(inputs, params[mode])) for mode in modes)
+
+
+def records(results):
+    """{mode: result} as JSON-ready detection records."""
+    return dict((mode, PROCESSOR[mode].record(result)) for mode, result in results.items())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# File name   : cv_replay.py
+# Description : Replay frames through the CV modes offline, robot commands recorded.
+#
+# Runs the same detection and control code as the CV thread (cv_modes plus
+# the CVThread apply methods) on a video, an image folder or a synthetic
+# scene. The robot module is replaced by a recorder before camera_opencv is
+# imported, so no serial port, camera or Pi is needed; every command the
+# modes would have sent is counted instead, and run through the same
+# RobotShadow as robot.py to count the ones that actually reach the serial port.
+# The findColor head control runs on replay time at its own rate; with
+# --gimbal-px every frame is shifted by the head offset the shadow tracks,
+# --gimbal-lag after the step was sent, so the head moves the picture and
+# time-to-lock and overshoot can be tuned offline.
+#
+# Usage:
+#   python3 cv_replay.py
+#   python3 cv_replay.py --source recording.mp4 --modes findlineCV,watchDog+faceDetection
+#   python3 cv_replay.py --source ./frames/ --set motionWidth=120 --log commands.jsonl
+#   python3 cv_replay.py --modes findColor --gimbal-px 10 --set gimbalGain=0.08
+import argparse
+import ast
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+import types
+import cv2
+import numpy as np
+from encode_benchmark import load_frames
+from serial_channel import COMMANDS, LIGHT_COLORS, RobotShadow
+
+# everything camera_opencv calls on the robot module
+ROBOT_COMMANDS = ('forward', 'backward', 'left', 'right', 'stopLR', 'stopFB',
+                  'lookUp', 'lookDown', 'lookStopUD', 'lookLeft', 'lookRight', 'lookStopLR',
+                  'steadyMode', 'jump', 'handShake', 'lightCtrl', 'buzzerCtrl', 'speedSet',
+                  'setUpperIP')
+ARG_COMMANDS = ('lightCtrl', 'buzzerCtrl')  # the first argument tells the commands apart
+
+
+class RecordingRobot(types.ModuleType):
+    """Stand-in for robot.py that records calls instead of writing to the serial port."""
+    def __init__(self):
+        super(RecordingRobot, self).__init__('robot')
+        self.calls = []  # (frame seq, command, passed the shadow)
+        self.seq = 0
+        self.now = 0.0  # replay time, for the shadow's refresh
+        self.shadow = RobotShadow()
+        for name in ROBOT_COMMANDS:
+            setattr(self, name, self.recorder(name))
+
+    def recorder(self, name):
+        def record(*args, **kwargs):
+            command = '%s(%s)' % (name, args[0]) if name in ARG_COMMANDS and args else name
+            if name in COMMANDS:
+                sent = self.shadow.admit(*COMMANDS[name], now=self.now)
+            elif name == 'lightCtrl':
+                sent = self.shadow.admit('light', LIGHT_COLORS.get(args[0], 0), now=self.now)
+            elif name == 'buzzerCtrl':
+                sent = self.shadow.admit('buzzer', args[0], now=self.now)
+            else:
+                sent = False  # not a serial command
+            self.calls.append((self.seq, command, sent))
+        return record
+
+
+robot = RecordingRobot()
+sys.modules['robot'] = robot
+import camera_opencv  # noqa: E402, must see the recording robot
+import cv_modes  # noqa: E402
+
+
+def synthetic_scene(count, width=640, height=480):
+    """A noisy floor with a drifting white line, a yellow ball and a box that comes and goes."""
+    rng = np.random.default_rng(0)
+    floor = cv2.GaussianBlur(rng.integers(40, 90, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+    frames = []
+    for i in range(count):
+        img = floor + rng.integers(0, 3, floor.shape, dtype=np.uint8)
+        # the line leans and drifts, so the steering goes left, straight and right
+        x = int(width / 2 + 120 * np.sin(i / 25.0))
+        lean = int(60 * np.sin(i / 40.0))
+        cv2.line(img, (x + lean, height // 3), (x, height), (255, 255, 255), 40)
+        ball = (int(width / 2 + 200 * np.cos(i / 30.0)), int(height / 3 + 80 * np.sin(i / 20.0)))
+        cv2.circle(img, ball, 35, (0, 220, 220), -1)
+        if i % 60 >= 40:
+            cv2.rectangle(img, (40 + i % 60 * 4, 40), (140 + i % 60 * 4, 140), (200, 60, 200), -1)
+        frames.append(img)
+    return frames
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def head_view(img, gimbal, pxPerUnit):
+    """img as the camera would see it with the head turned by the shadow's offset."""
+    if not pxPerUnit or not (gimbal['UD'] or gimbal['LR']):
+        return img
+    # head up moves the scene down in the picture, head right moves it left
+    shift = np.float32([[1, 0, -gimbal['LR'] * pxPerUnit], [0, 1, gimbal['UD'] * pxPerUnit]])
+    return cv2.warpAffine(img, shift, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+
+
+def replay(frames, modes, fps, pxPerUnit=0, lag=0):
+    """Run frames through modes like the CV thread; return (seconds per frame, cvt).
+
+    A head step shows in the frames captured `lag` seconds after it was sent.
+    """
+    cvt = camera_opencv.CVThread()
+    cvt.gimbal.threaded = False
+    params = cvt.detectParams(modes)
+    times = []
+    nextTick = 0.0
+    heads = collections.deque([(0.0, dict(robot.shadow.gimbal))])  # (sent at, head offset)
+    for seq, img in enumerate(frames, 1):
+        robot.seq = seq
+        capturedAt = robot.now = seq / fps
+        # the control ticks since the last frame, before this frame is taken
+        while nextTick <= capturedAt:
+            robot.now = nextTick
+            cvt.gimbal.tick(nextTick)
+            heads.append((nextTick, dict(robot.shadow.gimbal)))
+            nextTick += 1.0 / cvt.gimbal.rate
+        robot.now = capturedAt
+        while len(heads) > 1 and heads[1][0] <= capturedAt - lag:
+            heads.popleft()
+        img = head_view(img, heads[0][1], pxPerUnit)
+        start = time.perf_counter()
+        results = cvt.pipeline.run(img, modes, params)
+        cvt.applyResults(results, seq, capturedAt)
+        times.append(time.perf_counter() - start)
+    return times, cvt
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay frames through the CV modes without a robot.')
+    parser.add_argument('--source', help='video file or image folder, default a synthetic scene')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--fps', type=float, default=30.0, help='frame rate of the source, for commands/s')
+    parser.add_argument('--modes', default='findlineCV,findColor,watchDog,faceDetection',
+                        help="comma separated runs, modes of one run joined with '+'")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a camera_opencv setting, e.g. faceDistance=1.5')
+    parser.add_argument('--test-mode', action='store_true',
+                        help="findlineCV only shows its command, like CVMode != 'run'")
+    parser.add_argument('--threads', type=int, default=1, help='OpenCV threads, the Pi runs CV on one core')
+    parser.add_argument('--log', help='write every robot command as a JSON line to this file')
+    parser.add_argument('--refresh', type=float, default=0,
+                        help='resend unchanged states after this many seconds, like SERIAL_REFRESH')
+    parser.add_argument('--gimbal-px', type=float, default=0,
+                        help='stream pixels one unit of head offset moves the picture, 0 leaves the frames alone')
+    parser.add_argument('--gimbal-lag', type=float, default=0.1,
+                        help='seconds from a head step to the first frame that shows it')
+    args = parser.parse_args()
+
+    cv2.setNumThreads(args.threads)
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        if not hasattr(camera_opencv, name):
+            raise SystemExit(f"Unknown setting {name}")
+        setattr(camera_opencv, name, ast.literal_eval(value))
+    camera_opencv.Camera.CVMode = 'no' if args.test_mode else 'run'
+
+    if args.source:
+        frames = [cv2.resize(img, (640, 480)) for img in load_frames(args.source, args.frames)]
+    else:
+        frames = synthetic_scene(args.frames)
+    seconds = len(frames) / args.fps
+
+    log = open(args.log, 'w') if args.log else None
+    print('%d frames, %.1f s at %.0f fps' % (len(frames), seconds, args.fps))
+    # commands/s: what the modes call, writes/s: what passes the state shadow
+    print('%-34s %8s %8s %8s %8s %8s %10s %8s %8s' % (
+        'modes', 'fps', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'commands/s', 'writes/s', 'saved/s'))
+    for run in args.modes.split(','):
+        modes = cv_modes.ordered(run.split('+'))
+        if not modes:
+            raise SystemExit(f"Unknown mode {run}, expected one of {', '.join(cv_modes.MODES)}")
+        del robot.calls[:]
+        robot.shadow = RobotShadow(args.refresh)
+        # the modes print every steering command, keep the table readable
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            times, cvt = replay(frames, modes, args.fps, args.gimbal_px, args.gimbal_lag)
+        ms = [t * 1000 for t in times]
+        label = '+'.join(modes)
+        writes = sum(1 for call in robot.calls if call[2])
+        print('%-34s %8.1f %8.2f %8.2f %8.2f %8.2f %10.1f %8.1f %8.1f' % (
+            label, len(times) / sum(times), percentile(ms, 50), percentile(ms, 90),
+            percentile(ms, 99), max(ms), len(robot.calls) / seconds, writes / seconds,
+            (len(robot.calls) - writes) / seconds))
+        counts = collections.Counter(command for seq, command, sent in robot.calls)
+        if counts:
+            print('    ' + ', '.join('%s %d' % item for item in counts.most_common()))
+        if 'findColor' in modes:
+            gimbal = cvt.gimbal.stats()
+            line = '    gimbal: %d steps, %d locks, %d aborted' % (gimbal['steps'], gimbal['locks'], gimbal['aborted'])
+            if gimbal['locks']:
+                line += ', time to lock mean %(mean)d max %(max)d ms' % gimbal['time_to_lock_ms']
+                line += ', overshoot mean %(mean).1f max %(max)d px' % gimbal['overshoot_px']
+            print(line)
+        if log is not None:
+            for seq, command, sent in robot.calls:
+                log.write(json.dumps({'modes': label, 'seq': seq, 'command': command, 'sent': sent}) + '\n')
+    if log is not None:
+        log.close()
+
+
+if __name__ == '__main__':
+    main()
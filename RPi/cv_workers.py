@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# File name   : cv_workers.py
+# Description : Run the CV detectors in worker processes on shared-memory frames.
+#
+# The frame ring lives in shared memory, so a job is only (modes, slot, params)
+# and a result is the {mode: result} dict of the cv_modes pipeline. Workers are
+# fresh interpreters running this file; they only import cv_modes, never
+# robot, app or the camera, so they neither open the serial port nor start a
+# second camera thread (which multiprocessing's spawn would do by importing
+# the server's main module again).
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+import numpy as np
+import cv_modes
+
+
+def workerCount():
+    return int(os.environ.get('CV_WORKERS', 2))
+
+
+def attach(name):
+    """Map an existing shared memory block without taking ownership of it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached blocks with the resource tracker,
+        # which would unlink the ring when the worker exits
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def workerMain(fd, name, slots, shape, dtype, cascadePath):
+    """Entry point of a worker process; serves jobs until the parent goes away."""
+    conn = Connection(fd)
+    shm = attach(name)
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffers = [np.ndarray(shape, dtype, buffer=shm.buf, offset=i * nbytes) for i in range(slots)]
+    pipeline = cv_modes.Pipeline(cascadePath)
+    while True:
+        try:
+            modes, slot, params = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            reply = (pipeline.run(buffers[slot], modes, params), None)
+        except Exception as e:
+            reply = (None, repr(e))
+        try:
+            conn.send(reply)
+        except OSError:
+            break
+    buffers = None
+    shm.close()
+
+
+class CVWorker(object):
+    """One worker process plus the thread that feeds it jobs in order."""
+    def __init__(self, ring, cascadePath, lock):
+        self.lock = lock  # the pool's, guards inFlight
+        parent, child = socket.socketpair()
+        shape = ','.join(str(v) for v in ring.shape)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(child.fileno()), ring.shm.name,
+             str(len(ring.buffers)), shape, ring.dtype.str, cascadePath],
+            pass_fds=(child.fileno(),))
+        child.close()
+        self.conn = Connection(parent.detach())
+        self.jobs = queue.Queue()
+        self.inFlight = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            modes, lease, params, callback = job
+            try:
+                self.conn.send((modes, lease.index, params))
+                result, error = self.conn.recv()
+            except (EOFError, OSError) as e:
+                result, error = None, 'worker gone: %r' % e
+            lease.release()
+            with self.lock:
+                self.inFlight -= 1
+            callback(result, error)
+
+    def close(self):
+        self.jobs.put(None)
+        self.conn.close()
+        self.process.wait()
+
+
+class CVWorkerPool(object):
+    """Worker processes bound to one shared-memory FrameRing.
+
+    Frames for stateless modes are spread over all workers so several can
+    be in flight at once; as soon as one of the modes of a job keeps state
+    between frames, the job goes to the first worker.
+    """
+    def __init__(self, ring, cascadePath, workers=2):
+        if ring.shm is None:
+            raise ValueError('CVWorkerPool needs a FrameRing with shared=True')
+        self.ring = ring
+        self._lock = threading.Lock()
+        self.workers = [CVWorker(ring, cascadePath, self._lock) for i in range(workers)]
+
+    @staticmethod
+    def stateful(modes):
+        return any(mode in cv_modes.STATEFUL_MODES for mode in modes)
+
+    def capacity(self, modes):
+        return 1 if self.stateful(modes) else len(self.workers)
+
+    def full(self, modes):
+        if self.stateful(modes):
+            return self.workers[0].inFlight > 0
+        return all(worker.inFlight for worker in self.workers)
+
+    def submit(self, modes, lease, params, callback):
+        """Run the detectors of modes on a leased slot in a worker.
+
+        callback(results, error) is called from the worker's feeder thread
+        when done; the lease is released right before that.
+        """
+        with self._lock:
+            if self.stateful(modes):
+                worker = self.workers[0]
+            else:
+                worker = min(self.workers, key=lambda w: w.inFlight)
+            worker.inFlight += 1
+        worker.jobs.put((modes, lease, params, callback))
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.close()
+
+
+if __name__ == '__main__':
+    fd, name, slots, shape, dtype, cascadePath = sys.argv[1:7]
+    workerMain(int(fd), name, int(slots), tuple(int(v) for v in shape.split(',')), dtype, cascadePath)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# File name   : encode_benchmark.py
+# Description : Compare the JPEG encoder backends on synthetic and recorded frames.
+#
+# Usage:
+#   python3 encode_benchmark.py
+#   python3 encode_benchmark.py --source recording.mp4 --qualities 50,75,95
+#   python3 encode_benchmark.py --source ./frames/ --sizes 640x480
+import argparse
+import os
+import cv2
+import jpeg_encoder
+
+
+def load_frames(source, count):
+    """Read up to count frames from a video file or a folder of images."""
+    frames = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            img = cv2.imread(os.path.join(source, name))
+            if img is not None:
+                frames.append(img)
+            if len(frames) >= count:
+                break
+    else:
+        video = cv2.VideoCapture(source)
+        while len(frames) < count:
+            success, img = video.read()
+            if not success:
+                break
+            frames.append(img)
+        video.release()
+    if not frames:
+        raise SystemExit(f"No frames could be read from {source}")
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the JPEG encoder backends.')
+    parser.add_argument('--source', help='video file or image folder with recorded frames')
+    parser.add_argument('--sizes', default='640x480,1280x720')
+    parser.add_argument('--qualities', default='50,75,95')
+    parser.add_argument('--frames', type=int, default=30, help='frames per set')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',')]
+    qualities = [int(q) for q in args.qualities.split(',')]
+
+    sets = []
+    for width, height in sizes:
+        synthetic = [jpeg_encoder.synthetic_frame(width, height, seed) for seed in range(args.frames)]
+        sets.append(('synthetic %dx%d' % (width, height), synthetic))
+    if args.source:
+        recorded = load_frames(args.source, args.frames)
+        for width, height in sizes:
+            resized = [cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA) for img in recorded]
+            sets.append(('recorded %dx%d' % (width, height), resized))
+
+    encoders = jpeg_encoder.available_backends()
+    print('%-22s %-10s %7s %10s %12s' % ('frames', 'backend', 'quality', 'ms/frame', 'bytes/frame'))
+    for set_name, frames in sets:
+        for encoder in encoders:
+            encoder.encode(frames[0], qualities[0])  # warm up
+            for quality in qualities:
+                ms, size = jpeg_encoder.measure(encoder, frames, quality, args.repeat)
+                print('%-22s %-10s %7d %10.2f %12.0f' % (set_name, encoder.name, quality, ms, size))
+
+
+if __name__ == '__main__':
+    main()
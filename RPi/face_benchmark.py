@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# File name   : face_benchmark.py
+# Description : Speed/recall of the face detector at each detection scale.
+#
+# The faces found at native resolution are the reference; recall at a scale
+# is the share of them that are still found there.
+#
+# Usage:
+#   python3 face_benchmark.py ./faces/
+#   python3 face_benchmark.py ./faces/ --scales 1,0.5,0.25 --width 640
+import argparse
+import os
+import time
+import cv2
+import cv_detect
+
+thisPath = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_images(folder, width):
+    images = []
+    for name in sorted(os.listdir(folder)):
+        img = cv2.imread(os.path.join(folder, name), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            continue
+        if width and img.shape[1] != width:
+            height = int(round(img.shape[0] * width / float(img.shape[1])))
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        images.append(img)
+    if not images:
+        raise SystemExit(f"No images could be read from {folder}")
+    return images
+
+
+def overlap(a, b):
+    """Intersection over union of two (x, y, w, h) boxes."""
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(0, x1 - x0) * max(0, y1 - y0)
+    return inter / float(a[2] * a[3] + b[2] * b[3] - inter)
+
+
+def run(images, cascade, scale, repeat):
+    """Return (ms per image, boxes per image) at one detection scale."""
+    boxes = [cv_detect.detectFacesGray(img, cascade, scale) for img in images]
+    start = time.perf_counter()
+    for i in range(repeat):
+        for img in images:
+            cv_detect.detectFacesGray(img, cascade, scale)
+    ms = (time.perf_counter() - start) * 1000 / (repeat * len(images))
+    return ms, boxes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark face detection at several scales.')
+    parser.add_argument('folder', help='folder of test images')
+    parser.add_argument('--scales', default='1,0.75,0.5,0.35,0.25')
+    parser.add_argument('--width', type=int, default=640, help='stream width the images are resized to, 0 keeps them')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--iou', type=float, default=0.3, help='overlap that counts as the same face')
+    parser.add_argument('--cascade', default=os.path.join(thisPath, 'haarcascade_frontalface_default.xml'))
+    args = parser.parse_args()
+
+    images = load_images(args.folder, args.width)
+    cascade = cv2.CascadeClassifier(args.cascade)
+    scales = [float(s) for s in args.scales.split(',')]
+    width = images[0].shape[1]
+
+    baseMs, reference = run(images, cascade, 1.0, args.repeat)
+    total = sum(len(faces) for faces in reference)
+    print('%d images, %d reference faces at native resolution' % (len(images), total))
+    print('%6s %10s %8s %8s %8s %12s' % ('scale', 'ms/image', 'speedup', 'recall', 'faces', 'max dist m'))
+    for scale in scales:
+        ms, boxes = (baseMs, reference) if scale >= 1.0 else run(images, cascade, scale, args.repeat)
+        found = 0
+        for ref, got in zip(reference, boxes):
+            found += sum(1 for r in ref if any(overlap(r, g) >= args.iou for g in got))
+        recall = found / float(total) if total else float('nan')
+        # the distance at which a face shrinks to the cascade window at this scale
+        distance = cv_detect.faceMinSize(1.0, width) * scale / cv_detect.CASCADE_WINDOW
+        print('%6.2f %10.2f %7.1fx %8.2f %8d %12.1f' % (
+            scale, ms, baseMs / ms, recall, sum(len(b) for b in boxes), distance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# File name   : frame_ring.py
+# Description : Preallocated ring of raw frame buffers shared by capture, CV and encoder.
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+# closed shared blocks that some array still pointed into, unmapped later
+_retired = []
+
+
+def _sweep():
+    # unmap the retired blocks nothing points into any more
+    for shm in list(_retired):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        _retired.remove(shm)
+
+
+class FrameLease(object):
+    """Read access to one ring slot; the slot is not overwritten until released."""
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+        self.array = ring.buffers[index]
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.ring._release(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FrameRing(object):
+    """Fixed number of preallocated frame buffers with explicit ownership.
+
+    The capture side takes a free slot with acquire(), fills it in place and
+    hands it over with commit(). Readers (CV thread, encoder) take read
+    leases on committed slots; a slot with a lease is never handed to the
+    writer, so nobody sees a frame that is being overwritten. If every slot
+    is leased the frame is dropped instead of allocating a new buffer.
+    """
+    WRITING = -1
+
+    def __init__(self, slots, shape, dtype=np.uint8, shared=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = None
+        if shared:
+            # one shared memory block so that CV worker processes can map
+            # the very same slots (see cv_workers.py)
+            nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes * slots)
+            # frombuffer() holds the buffer, so the block cannot be unmapped
+            # under an array that still points into it (see close())
+            self.buffers = [np.frombuffer(self.shm.buf, self.dtype, nbytes // self.dtype.itemsize,
+                                          i * nbytes).reshape(self.shape)
+                            for i in range(slots)]
+        else:
+            self.buffers = [np.zeros(self.shape, self.dtype) for i in range(slots)]
+        self._leases = [0] * slots  # read leases per slot, WRITING while being filled
+        self._next = 0
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.drops = 0  # captures skipped because every slot was leased
+        self.contention = 0  # slots the writer had to skip because they were leased
+
+    def fits(self, shape, dtype=np.uint8, shared=False):
+        return (self.shape == tuple(shape) and self.dtype == np.dtype(dtype)
+                and (self.shm is not None) == shared)
+
+    def close(self):
+        """Free the shared memory block, if any; the ring is unusable afterwards.
+
+        The block is unlinked at once. Arrays of the last frames (leases,
+        the camera's latest frame, the CV image) may still point into it,
+        so it is only unmapped once none does, here or at a later close().
+        """
+        _sweep()
+        with self._lock:
+            shm, self.shm = self.shm, None
+            if shm is None:
+                return
+            self.buffers = []
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            _retired.append(shm)
+
+    def acquire(self):
+        """Return the index of a free slot for writing, or None (frame dropped)."""
+        with self._lock:
+            slots = len(self.buffers)
+            for i in range(slots):
+                index = (self._next + i) % slots
+                if self._leases[index] == 0:
+                    self._leases[index] = FrameRing.WRITING
+                    self._next = (index + 1) % slots
+                    return index
+                self.contention += 1
+            self.drops += 1
+            return None
+
+    def commit(self, index):
+        """Finish writing a slot and return a lease on it for the writer."""
+        with self._lock:
+            self._leases[index] = 1
+            self.writes += 1
+        return FrameLease(self, index)
+
+    def lease(self, index):
+        """Take an additional read lease on a committed slot."""
+        with self._lock:
+            if self._leases[index] <= 0:
+                raise ValueError('slot %d is not readable' % index)
+            self._leases[index] += 1
+        return FrameLease(self, index)
+
+    def readers(self, index):
+        """Number of read leases currently held on a slot."""
+        return max(self._leases[index], 0)
+
+    def _release(self, index):
+        with self._lock:
+            self._leases[index] -= 1
+
+    def stats(self):
+        with self._lock:
+            leased = sum(1 for count in self._leases if count > 0)
+        return {
+            'slots': len(self.buffers),
+            'leased': leased,
+            'writes': self.writes,
+            'drops': self.drops,
+            'contention': self.contention,
+        }
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# File name   : gimbal_control.py
+# Description : Proportional, rate-limited head (gimbal) control for findColor.
+#
+# The firmware moves the head by a fixed step per ges command, so the
+# controller turns the pixel error into a number of steps: every control
+# tick adds gain * error to a per-axis accumulator and sends the whole steps
+# in it, at most maxSteps per axis and tick. Inside the deadband the axis is
+# locked and the accumulator cleared. The controller runs at its own rate,
+# not the CV frame rate, and uses each target position once, and only if it
+# was captured at least `settle` after the last step went out: acting again
+# on a frame that does not show the previous step yet is what made the old
+# per-frame stepping overshoot.
+import threading
+import time
+
+CONTROL_RATE = 20.0  # Hz
+MAX_STEPS = 2  # per axis and control tick
+STALE = 0.5  # s; an older target position is not acted on
+SETTLE = 0.1  # s from a step until a frame is expected to show it (serial, servo, camera)
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+class GimbalController(object):
+    """Steers the head towards a target at a fixed control rate.
+
+    step(axis, direction) sends one step: axis 'LR' or 'UD', direction +1
+    towards larger x (right) or y (down). Time-to-lock and overshoot are
+    measured per episode, from the target leaving the deadband (or
+    appearing) until both axes are inside it again.
+    """
+    def __init__(self, step, center=(320, 240), deadband=27, gain=0.05,
+                 rate=CONTROL_RATE, maxSteps=MAX_STEPS, settle=SETTLE, threaded=True):
+        self.step = step
+        self.center = center
+        self.deadband = deadband
+        self.gain = gain  # steps per pixel of error
+        self.rate = rate
+        self.maxSteps = maxSteps
+        self.settle = settle
+        self.threaded = threaded
+        self.thread = None
+        self.target = None  # (x, y, captured at), replaced as a whole
+        self.used = 0.0  # capture time of the last target acted on
+        self.lastStep = 0.0
+        self.acc = {'LR': 0.0, 'UD': 0.0}
+        self.episode = None
+        self.counters = {'steps': 0, 'locks': 0, 'aborted': 0}
+        self.lockTimes = []  # s, last 50 episodes
+        self.overshoots = []  # px
+
+    def update(self, x, y, capturedAt):
+        """Latest target position in stream pixels (CV thread)."""
+        self.target = (x, y, capturedAt)
+        if self.threaded and self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def lost(self):
+        self.target = None
+
+    def run(self):
+        period = 1.0 / self.rate
+        next_tick = time.time()
+        while True:
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()
+            self.tick(time.time())
+
+    def tick(self, now):
+        target = self.target
+        if target is None or now - target[2] > STALE:
+            if self.episode is not None:
+                self.counters['aborted'] += 1
+                self.episode = None
+            self.acc = {'LR': 0.0, 'UD': 0.0}
+            return
+        x, y, capturedAt = target
+        if capturedAt <= self.used or capturedAt <= self.lastStep + self.settle:
+            return
+        self.used = capturedAt
+        errors = {'LR': x - self.center[0], 'UD': y - self.center[1]}
+        self.measure(errors, capturedAt)
+        for axis, error in errors.items():
+            if abs(error) <= self.deadband:
+                self.acc[axis] = 0.0
+                continue
+            self.acc[axis] += self.gain * error
+            steps = max(-self.maxSteps, min(self.maxSteps, int(self.acc[axis])))
+            if steps:
+                self.acc[axis] -= steps
+                for i in range(abs(steps)):
+                    self.step(axis, sign(steps))
+                self.counters['steps'] += abs(steps)
+                self.lastStep = now
+
+    def measure(self, errors, capturedAt):
+        locked = all(abs(error) <= self.deadband for error in errors.values())
+        episode = self.episode
+        if episode is None:
+            if locked:
+                return
+            episode = self.episode = {'start': capturedAt, 'overshoot': 0,
+                                      'sign': dict((axis, sign(error)) for axis, error in errors.items())}
+        for axis, error in errors.items():
+            # past the centre on the other side than where the target started
+            if episode['sign'][axis] and sign(error) == -episode['sign'][axis]:
+                episode['overshoot'] = max(episode['overshoot'], abs(error))
+        if locked:
+            self.episode = None
+            self.counters['locks'] += 1
+            lockTime = capturedAt - episode['start']
+            self.lockTimes = (self.lockTimes + [lockTime])[-50:]
+            self.overshoots = (self.overshoots + [episode['overshoot']])[-50:]
+            print('Gimbal locked in %.2f s, overshoot %d px' % (lockTime, episode['overshoot']))
+
+    def stats(self):
+        stats = dict(self.counters)
+        lockTimes = self.lockTimes
+        overshoots = self.overshoots
+        if lockTimes:
+            stats['time_to_lock_ms'] = {
+                'last': round(lockTimes[-1] * 1000),
+                'mean': round(sum(lockTimes) * 1000 / len(lockTimes)),
+                'max': round(max(lockTimes) * 1000),
+            }
+            stats['overshoot_px'] = {
+                'last': round(overshoots[-1]),
+                'mean': round(sum(overshoots) / len(overshoots), 1),
+                'max': round(max(overshoots)),
+            }
+        return stats
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# File name   : jpeg_encoder.py
+# Description : Interchangeable JPEG encoder backends for the video stream.
+import io
+import os
+import time
+import cv2
+import numpy as np
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    import turbojpeg
+    TURBOJPEG_AVAILABLE = True
+except ImportError:
+    TURBOJPEG_AVAILABLE = False
+
+
+class OpenCVEncoder(object):
+    """cv2.imencode, always available."""
+    name = 'opencv'
+
+    def encode(self, img, quality):
+        return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+class PillowEncoder(object):
+    """Pillow (or Pillow-SIMD, which installs under the same name)."""
+    name = 'pillow'
+
+    def encode(self, img, quality):
+        img = np.ascontiguousarray(img)
+        height, width = img.shape[:2]
+        # let Pillow unpack BGR/BGRX itself instead of converting in numpy
+        if img.ndim == 2:
+            pil_img = Image.frombuffer('L', (width, height), img, 'raw', 'L', 0, 1)
+        elif img.shape[2] == 4:
+            pil_img = Image.frombuffer('RGB', (width, height), img, 'raw', 'BGRX', 0, 1)
+        else:
+            pil_img = Image.frombuffer('RGB', (width, height), img, 'raw', 'BGR', 0, 1)
+        out = io.BytesIO()
+        pil_img.save(out, format='JPEG', quality=quality)
+        return out.getvalue()
+
+
+class TurboJPEGEncoder(object):
+    """libjpeg-turbo through the PyTurboJPEG bindings."""
+    name = 'turbojpeg'
+
+    def __init__(self):
+        self.jpeg = turbojpeg.TurboJPEG()
+
+    def encode(self, img, quality):
+        img = np.ascontiguousarray(img)
+        if img.ndim == 2:
+            return self.jpeg.encode(img[:, :, None], quality=quality,
+                                    pixel_format=turbojpeg.TJPF_GRAY,
+                                    jpeg_subsample=turbojpeg.TJSAMP_GRAY)
+        if img.shape[2] == 4:
+            return self.jpeg.encode(img, quality=quality, pixel_format=turbojpeg.TJPF_BGRX)
+        return self.jpeg.encode(img, quality=quality, pixel_format=turbojpeg.TJPF_BGR)
+
+
+BACKENDS = {
+    'opencv': OpenCVEncoder,
+    'pillow': PillowEncoder,
+    'turbojpeg': TurboJPEGEncoder,
+}
+
+
+def available_backends():
+    """Return instances of every backend that can be used on this system."""
+    encoders = [OpenCVEncoder()]
+    if PIL_AVAILABLE:
+        encoders.append(PillowEncoder())
+    if TURBOJPEG_AVAILABLE:
+        try:
+            encoders.append(TurboJPEGEncoder())
+        except Exception as e:
+            # the python package is there but libturbojpeg.so is not
+            print(f"Warning: turbojpeg not usable: {e}")
+    return encoders
+
+
+def synthetic_frame(width=640, height=480, seed=0):
+    """Return a BGR test image with gradients, edges and sensor-like noise."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:, :, 0] = x
+    img[:, :, 1] = y
+    img[:, :, 2] = (x + y) / 2
+    for i in range(8):
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(img, (cx, cy), int(rng.integers(10, height // 4)), color, -1)
+    noise = rng.integers(-8, 9, img.shape, dtype=np.int16)
+    return np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def measure(encoder, frames, quality, repeat=1):
+    """Encode every frame repeat times; return (ms per frame, bytes per frame)."""
+    total_bytes = 0
+    count = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        for img in frames:
+            total_bytes += len(encoder.encode(img, quality))
+            count += 1
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000.0 / count, total_bytes / float(count)
+
+
+def select_encoder(name=None):
+    """Return the configured encoder, or the fastest available one.
+
+    name (or the JPEG_ENCODER environment variable) may be 'opencv',
+    'pillow', 'turbojpeg' or 'auto'. An unavailable backend falls back to
+    'auto' with a warning.
+    """
+    if name is None:
+        name = os.environ.get('JPEG_ENCODER', 'auto')
+
+    encoders = available_backends()
+    if name != 'auto':
+        for encoder in encoders:
+            if encoder.name == name:
+                print(f"INFO: JPEG encoder: {encoder.name}")
+                return encoder
+        print(f"Warning: JPEG encoder {name!r} not available, picking the fastest one")
+
+    if len(encoders) == 1:
+        return encoders[0]
+    frames = [synthetic_frame()]
+    timings = []
+    for encoder in encoders:
+        encoder.encode(frames[0], 80)  # warm up
+        timings.append((measure(encoder, frames, 80, repeat=5)[0], encoder.name, encoder))
+    timings.sort(key=lambda t: t[0])
+    print('INFO: JPEG encoder: %s (%s)' % (timings[0][1],
+          ', '.join('%s %.1f ms' % (t[1], t[0]) for t in timings)))
+    return timings[0][2]
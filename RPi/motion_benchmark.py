@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# File name   : motion_benchmark.py
+# Description : CPU per frame of the watchDog motion detector, old and new.
+#
+# "full-res" is the detector watchDog used before: 21x21 blur, float64
+# background and contours on the whole frame. Both see the same frames;
+# "agree" is the share of frames on which both report motion or both don't.
+#
+# Usage:
+#   python3 motion_benchmark.py
+#   python3 motion_benchmark.py --source recording.mp4 --width 160,120,80
+import argparse
+import time
+import cv2
+import numpy as np
+import cv_detect
+from encode_benchmark import load_frames
+
+
+class FullResDetector(object):
+    def __init__(self, minArea=2000):
+        self.avg = None
+        self.minArea = minArea
+
+    def update(self, imgInput):
+        gray = cv2.cvtColor(imgInput, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (21, 21), 0)
+        if self.avg is None:
+            self.avg = gray.copy().astype("float")
+            return None
+        cv2.accumulateWeighted(gray, self.avg, 0.5)
+        frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+        thresh = cv2.threshold(frameDelta, 5, 255, cv2.THRESH_BINARY)[1]
+        thresh = cv2.dilate(thresh, None, iterations=2)
+        cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        return [cv2.boundingRect(c) for c in cnts if cv2.contourArea(c) >= self.minArea]
+
+
+def synthetic_frames(count, width=640, height=480):
+    """A noisy static scene with a square walking through it."""
+    rng = np.random.default_rng(0)
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+    frames = []
+    for i in range(count):
+        img = scene.copy()
+        img += rng.integers(0, 3, img.shape, dtype=np.uint8)
+        if i % 40 >= 20:
+            x = (i * 12) % (width - 80)
+            cv2.rectangle(img, (x, 200), (x + 80, 280), (255, 255, 255), -1)
+        frames.append(img)
+    return frames
+
+
+def run(detector, frames):
+    """Return (CPU ms per frame, wall ms per frame, motion flag per frame)."""
+    detector.update(frames[0])
+    moving = []
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for img in frames[1:]:
+        moving.append(bool(detector.update(img)))
+    n = len(frames) - 1
+    return ((time.process_time() - cpu) * 1000 / n, (time.perf_counter() - wall) * 1000 / n, moving)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the watchDog motion detector.')
+    parser.add_argument('--source', help='video file or image folder, default synthetic frames')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--width', default='160,120,80', help='thumbnail widths to try')
+    parser.add_argument('--threads', type=int, default=1, help='OpenCV threads, the Pi runs CV on one core')
+    args = parser.parse_args()
+
+    cv2.setNumThreads(args.threads)
+    if args.source:
+        frames = [cv2.resize(img, (640, 480)) for img in load_frames(args.source, args.frames)]
+    else:
+        frames = synthetic_frames(args.frames)
+
+    cpu, wall, reference = run(FullResDetector(), frames)
+    print('%-14s %10s %10s %8s %8s' % ('detector', 'cpu ms', 'wall ms', 'motion', 'agree'))
+    print('%-14s %10.2f %10.2f %8d %8s' % ('full-res', cpu, wall, sum(reference), '-'))
+    for width in [int(w) for w in args.width.split(',')]:
+        cpu, wall, moving = run(cv_detect.MotionDetector(width=width), frames)
+        agree = sum(a == b for a, b in zip(reference, moving)) / float(len(moving))
+        print('%-14s %10.2f %10.2f %8d %8.2f' % ('thumb %d' % width, cpu, wall, sum(moving), agree))
+
+
+if __name__ == '__main__':
+    main()
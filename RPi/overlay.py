@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# File name   : overlay.py
+# Description : Cached static overlay layers for the CV annotations.
+import collections
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+class OverlayLayer(object):
+    """A static overlay that is drawn once and stamped onto every frame.
+
+    Lines and text are drawn onto a black canvas and, with the same
+    geometry, into a coverage mask. finalize() keeps only the covered
+    pixels, so stamping costs a few thousand pixels instead of redrawing
+    every primitive. The canvas is premultiplied by the coverage, which keeps
+    the antialiased text edges intact.
+    """
+    def __init__(self, shape, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.canvas = np.zeros(self.shape, dtype)
+        self.mask = np.zeros(self.shape[:2], np.uint8)
+        self._index = None
+        self._alpha = None
+        self._pixels = None
+
+    def line(self, pt1, pt2, color, thickness=1):
+        cv2.line(self.canvas, pt1, pt2, color, thickness)
+        cv2.line(self.mask, pt1, pt2, 255, thickness)
+
+    def text(self, text, org, color, scale=0.5, thickness=1):
+        cv2.putText(self.canvas, text, org, FONT, scale, color, thickness, cv2.LINE_AA)
+        cv2.putText(self.mask, text, org, FONT, scale, 255, thickness, cv2.LINE_AA)
+
+    def finalize(self):
+        channels = 1 if len(self.shape) == 2 else self.shape[2]
+        self._index = np.flatnonzero(self.mask)
+        self._alpha = (255 - self.mask.reshape(-1)[self._index]).astype(np.uint16)[:, None]
+        self._pixels = self.canvas.reshape(-1, channels)[self._index].astype(np.uint16)
+        # only the covered pixels are needed from here on
+        self.canvas = None
+        self.mask = None
+
+    def apply(self, img):
+        """Composite the layer onto img in place (img must be contiguous)."""
+        flat = img.reshape(-1, self._pixels.shape[1])
+        under = flat[self._index].astype(np.uint16)
+        blended = (under * self._alpha + 127) // 255 + self._pixels
+        flat[self._index] = np.minimum(blended, 255)
+
+
+class OverlayCache(object):
+    """Static layers by key; a layer is built on first use of its key.
+
+    The key must contain every parameter the layer depends on, so that a
+    changed parameter simply produces a new layer.
+    """
+    def __init__(self, size=16):
+        self.size = size
+        self.layers = collections.OrderedDict()
+
+    def stamp(self, img, key, build):
+        """Apply the layer for key to img, building it with build(layer) if needed."""
+        key = (key, img.shape, img.dtype.str)
+        layer = self.layers.get(key)
+        if layer is None:
+            layer = OverlayLayer(img.shape, img.dtype)
+            build(layer)
+            layer.finalize()
+            self.layers[key] = layer
+            if len(self.layers) > self.size:
+                self.layers.popitem(last=False)
+        layer.apply(img)
+        return img
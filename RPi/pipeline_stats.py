@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# File name   : pipeline_stats.py
+# Description : Rolling latency percentiles per frame pipeline stage and CV mode.
+import bisect
+import collections
+import threading
+import time
+
+# bucket upper bounds in seconds, 0.1 ms up to ~12 s in 20 % steps
+BUCKETS = [0.0001 * 1.2 ** i for i in range(65)]
+WINDOW = 30.0  # s; percentiles cover the current and the previous window
+
+# stages a frame goes through, in order
+STAGES = (
+    'capture',   # sensor read into the frame ring
+    'cv_wait',   # capture until the CV thread starts on the frame
+    'cv',        # CV algorithm
+    'draw',      # overlays
+    'encode',    # JPEG encode, per profile
+    'delivery',  # capture until the frame is handed to a client
+)
+
+_lock = threading.Lock()
+_histograms = {}
+
+
+class Histogram(object):
+    """Fixed-size latency histogram over a rolling time window.
+
+    Two sets of bucket counters are kept and the older one is cleared every
+    WINDOW seconds, so memory never grows and old regressions age out.
+    """
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.counts = [[0] * (len(BUCKETS) + 1), [0] * (len(BUCKETS) + 1)]
+        self.current = 0
+        self.rotated = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, seconds, now=None):
+        if now is None:
+            now = time.time()
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            if now - self.rotated > self.window:
+                self.current ^= 1
+                self.counts[self.current] = [0] * (len(BUCKETS) + 1)
+                self.rotated = now
+            self.counts[self.current][index] += 1
+
+    def percentiles(self, points=(50, 95, 99)):
+        """Return {point: upper bucket bound in ms} and the sample count."""
+        with self._lock:
+            merged = [a + b for a, b in zip(*self.counts)]
+        count = sum(merged)
+        result = {}
+        if not count:
+            return result, 0
+        for point in points:
+            rank = count * point / 100.0
+            seen = 0
+            for index, n in enumerate(merged):
+                seen += n
+                if seen >= rank:
+                    break
+            bound = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+            result[point] = round(bound * 1000.0, 2)
+        return result, count
+
+
+class Rate(object):
+    """Events per second over the last `window` seconds."""
+    def __init__(self, window=5.0):
+        self.window = window
+        self.times = collections.deque()
+
+    def tick(self, now=None):
+        if now is None:
+            now = time.time()
+        self.times.append(now)
+        while now - self.times[0] > self.window:
+            self.times.popleft()
+
+    def rate(self, now=None):
+        if now is None:
+            now = time.time()
+        while self.times and now - self.times[0] > self.window:
+            self.times.popleft()
+        return len(self.times) / self.window
+
+
+def record(stage, seconds, mode='none'):
+    """Record the duration of a pipeline stage for the active CV mode."""
+    key = (mode, stage)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.record(seconds)
+
+
+def snapshot():
+    """Return {mode: {stage: {'p50', 'p95', 'p99', 'count'}}} in milliseconds."""
+    with _lock:
+        items = list(_histograms.items())
+    result = {}
+    for (mode, stage), histogram in items:
+        percentiles, count = histogram.percentiles()
+        if not count:
+            continue
+        result.setdefault(mode, {})[stage] = {
+            'p50': percentiles[50],
+            'p95': percentiles[95],
+            'p99': percentiles[99],
+            'count': count,
+        }
+    return result
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
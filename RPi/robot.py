@@ -3,10 +3,14 @@
 # Description : Robot interfaces.
 import time
 import json
+import asyncio
 import serial
 
 import os
 import sys
+import serial_channel
+import serial_telemetry
+from serial_channel import COMMANDS, LIGHT_COLORS
 
 # Global variables
 ser = None
@@ -44,12 +48,71 @@ def ensure_serial():
         if not init_serial():
             print("Serial connection not available - command ignored")
             return False
+        # a reopened port may lead to a reset ESP32: resend every state
+        shadow.forget()
     return True
 
 # Initialize serial connection on module import
 init_serial()
 
 
+def write_serial(data):
+    """Write one encoded command; only the channel's writer thread calls this."""
+    global ser
+    if not ensure_serial():
+        return False
+    try:
+        ser.write(data)
+    except serial.SerialException:
+        # reopened by the next write
+        ser = None
+        raise
+    return True
+
+# Every command goes through this queue, callers never wait for the UART;
+# the shadow drops commands that would not change the robot's state, and
+# written commands are matched with the firmware's echo lines
+echo = serial_telemetry.EchoTracker()
+channel = serial_channel.SerialChannel(write_serial, onWrite=echo.sent)
+shadow = serial_channel.RobotShadow()
+
+def send(var, val):
+    """Queue a command for the ESP32 and return at once."""
+    if shadow.admit(var, val):
+        channel.put(var, val)
+
+def send_confirmed(var, val):
+    """Queue a command even if the shadow has it already and return a
+    concurrent.futures.Future with its echo round trip in seconds
+    (see EchoTracker.confirm)."""
+    future = echo.confirm(var, val)
+    shadow.admit(var, val)
+    channel.put(var, val)
+    return future
+
+async def confirm(var, val, timeout=serial_telemetry.ECHO_TIMEOUT):
+    """Awaitable send_confirmed(); raises TimeoutError without an echo."""
+    return await asyncio.wait_for(asyncio.wrap_future(send_confirmed(var, val)), timeout)
+
+def read_serial():
+    """Whatever the ESP32 has sent, waiting up to the port timeout for it."""
+    port = ser
+    if port is None:
+        time.sleep(1)
+        return b''
+    return port.read(port.in_waiting or 1)
+
+# Drains the port so the RX buffer never fills; keeps the last voltage etc.
+telemetry = serial_telemetry.TelemetryReader(read_serial, onLine=echo.received)
+telemetry.start()
+
+def stats():
+    stats = channel.stats()
+    stats['shadow'] = shadow.stats()
+    stats['echo'] = echo.stats()
+    return stats
+
+
 pitch, roll = 0, 0
 
 
@@ -58,145 +121,77 @@ def setUpperIP(ipInput):
 	upperGlobalIP = ipInput
 
 def forward(speed=100):
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"move", 'val':1})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['forward'])
 	print('robot-forward')
 
 def backward(speed=100):
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"move", 'val':5})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['backward'])
 	print('robot-backward')
 
 def left(speed=100):
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"move", 'val':2})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['left'])
 	print('robot-left')
 
 def right(speed=100):
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"move", 'val':4})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['right'])
 	print('robot-right')
 
 def stopLR():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"move", 'val':6})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['stopLR'])
 	print('robot-stop')
 
 def stopFB():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"move", 'val':3})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['stopFB'])
 	print('robot-stop')
 
 
 
 def lookUp():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"ges", 'val':1})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['lookUp'])
 	print('robot-lookUp')
 
 def lookDown():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"ges", 'val':2})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['lookDown'])
 	print('robot-lookDown')
 
 def lookStopUD():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"ges", 'val':3})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['lookStopUD'])
 	print('robot-lookStopUD')
 
 def lookLeft():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"ges", 'val':4})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['lookLeft'])
 	print('robot-lookLeft')
 
 def lookRight():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"ges", 'val':5})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['lookRight'])
 	print('robot-lookRight')
 
 def lookStopLR():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"ges", 'val':6})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['lookStopLR'])
 	print('robot-lookStopLR')
 
 
 
 def steadyMode():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"funcMode", 'val':1})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['steadyMode'])
 	print('robot-steady')
 
 def jump():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"funcMode", 'val':4})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['jump'])
 	print('robot-jump')
 
 def handShake():
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"funcMode", 'val':3})
-	ser.write(dataCMD.encode())
+	send(*COMMANDS['handShake'])
 	print('robot-handshake')
 
 
 
 def lightCtrl(colorName, cmdInput):
-	if not ensure_serial():
-		return
-	colorNum = 0
-	if colorName == 'off':
-		colorNum = 0
-	elif colorName == 'blue':
-		colorNum = 1
-	elif colorName == 'red':
-		colorNum = 2
-	elif colorName == 'green':
-		colorNum = 3
-	elif colorName == 'yellow':
-		colorNum = 4
-	elif colorName == 'cyan':
-		colorNum = 5
-	elif colorName == 'magenta':
-		colorNum = 6
-	elif colorName == 'cyber':
-		colorNum = 7
-	dataCMD = json.dumps({'var':"light", 'val':colorNum})
-	ser.write(dataCMD.encode())
+	send('light', LIGHT_COLORS.get(colorName, 0))
 
 
 def buzzerCtrl(buzzerCtrl, cmdInput):
-	if not ensure_serial():
-		return
-	dataCMD = json.dumps({'var':"buzzer", 'val':buzzerCtrl})
-	ser.write(dataCMD.encode())
+	send('buzzer', buzzerCtrl)
 
 
 
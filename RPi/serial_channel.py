@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# File name   : serial_channel.py
+# Description : Robot command queue with one writer thread that owns the serial port.
+#
+# Callers (websocket loop, Flask threads, CV thread) only put a command into
+# the queue and return. The writer sends them to the ESP32 no faster than the
+# firmware reads them: serialCtrl() parses one JSON document every 25 ms and
+# a backlog in its UART buffer is only worked off later or overflows. While
+# a command waits, a newer one for the same thing replaces it in place:
+#   move       per axis, forward/backward/stop FB and left/right/stop LR
+#   ges        per axis; the firmware steps the head by a fixed amount per
+#              command, so steps are summed (up + down cancel) and sent one
+#              by one, a pending stop is a no-op and is absorbed
+#   light, buzzer  the last state wins
+# Everything else (funcMode: steady toggle, jump, ...) is sent in order.
+#
+# In front of the queue, RobotShadow keeps the last commanded state and drops
+# commands that would not change it, e.g. the light the CV modes set on
+# every frame or the same steering command frame after frame.
+import collections
+import json
+import os
+import threading
+import time
+import pipeline_stats
+
+WRITE_INTERVAL = float(os.environ.get('SERIAL_WRITE_INTERVAL', 0.025))  # s between commands
+# resend an unchanged state if it was last sent this many seconds ago, 0 never
+REFRESH = float(os.environ.get('SERIAL_REFRESH', 0))
+FIFO_MAX = 64  # queued uncoalesced commands; the oldest is dropped beyond that
+GES_MAX_STEPS = 15  # more steps than this run into the firmware's clamp anyway
+
+# robot.py function -> (var, val) it sends
+COMMANDS = {
+    'forward': ('move', 1),
+    'left': ('move', 2),
+    'stopFB': ('move', 3),
+    'right': ('move', 4),
+    'backward': ('move', 5),
+    'stopLR': ('move', 6),
+    'lookUp': ('ges', 1),
+    'lookDown': ('ges', 2),
+    'lookStopUD': ('ges', 3),
+    'lookLeft': ('ges', 4),
+    'lookRight': ('ges', 5),
+    'lookStopLR': ('ges', 6),
+    'steadyMode': ('funcMode', 1),
+    'handShake': ('funcMode', 3),
+    'jump': ('funcMode', 4),
+}
+LIGHT_COLORS = {'off': 0, 'blue': 1, 'red': 2, 'green': 3, 'yellow': 4, 'cyan': 5, 'magenta': 6, 'cyber': 7}
+
+# ges val -> (axis, step); 3 and 6 stop the axis
+GES_STEPS = {1: ('UD', 1), 2: ('UD', -1), 3: ('UD', 0), 4: ('LR', -1), 5: ('LR', 1), 6: ('LR', 0)}
+GES_VALS = {('UD', 1): 1, ('UD', -1): 2, ('UD', 0): 3, ('LR', -1): 4, ('LR', 1): 5, ('LR', 0): 6}
+GES_SPEED = 2  # gestureSpeed in the firmware, offset per ges command
+GES_OFFSET_MAX = 15  # gestureOffSetMax, the offset is clamped to +-this
+
+
+def slot_of(var, val):
+    """Coalescing slot of a command, None for commands that are never merged."""
+    if var == 'move':
+        return 'move.FB' if val in (1, 3, 5) else 'move.LR'
+    if var == 'ges' and val in GES_STEPS:
+        return 'ges.' + GES_STEPS[val][0]
+    if var in ('light', 'buzzer'):
+        return var
+    return None
+
+
+class RobotShadow(object):
+    """Last commanded state of the ESP32; admit() says whether a command changes it.
+
+    move FB/LR, light and buzzer are states. ges moves the head by GES_SPEED
+    per command, so the shadow tracks the offset as the firmware clamps it.
+    funcMode is an action and always sent; it also resets the head offset
+    to 0, like the firmware does. The firmware's side effects are followed
+    too: move and ges set funcMode to 0 and move switches the buzzer off.
+    So a repeated move, a ges step at the limit or a ges stop is only
+    dropped while funcMode is known to be 0; otherwise it still ends the
+    steady mode.
+    """
+    def __init__(self, refresh=REFRESH):
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.state = {}  # slot -> (val, last sent)
+        self.gimbal = {'UD': 0, 'LR': 0}
+        self.funcMode = None  # None while unknown
+        self.counters = {'sent': 0, 'suppressed': 0}
+        self.suppressed = collections.Counter()  # per var
+
+    def admit(self, var, val, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            send = self.changes(var, val, now)
+            self.counters['sent' if send else 'suppressed'] += 1
+            if not send:
+                self.suppressed[var] += 1
+            return send
+
+    def changes(self, var, val, now):
+        if var == 'funcMode':
+            self.gimbal = {'UD': 0, 'LR': 0}
+            if val != 1:
+                self.funcMode = val
+            elif self.funcMode in (0, 1):
+                self.funcMode = 1 - self.funcMode  # steady mode toggles
+            else:
+                self.funcMode = None
+            return True
+        if var == 'ges':
+            if val not in GES_STEPS:
+                return True
+            axis, step = GES_STEPS[val]
+            offset = max(-GES_OFFSET_MAX, min(GES_OFFSET_MAX, self.gimbal[axis] + step * GES_SPEED))
+            if offset == self.gimbal[axis] and self.funcMode == 0:
+                return False
+            self.gimbal[axis] = offset
+            self.funcMode = 0
+            return True
+        slot = slot_of(var, val)
+        if slot is None:
+            return True
+        last = self.state.get(slot)
+        # a repeated move still ends the steady mode or another action
+        unchanged = var != 'move' or self.funcMode == 0
+        if (unchanged and last is not None and last[0] == val
+                and not (self.refresh and now - last[1] >= self.refresh)):
+            return False
+        self.state[slot] = (val, now)
+        if var == 'move':
+            self.funcMode = 0
+            # the firmware switches the buzzer off on every move
+            self.state.pop('buzzer', None)
+        return True
+
+    def forget(self):
+        """Unknown ESP32 state (e.g. after a reset): the next commands all go out."""
+        with self.lock:
+            self.state.clear()
+            self.gimbal = {'UD': 0, 'LR': 0}
+            self.funcMode = None
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['suppressed_by_var'] = dict(self.suppressed)
+            stats['gimbal'] = dict(self.gimbal)
+        return stats
+
+
+class SerialChannel(object):
+    """Non-blocking command queue in front of write(bytes).
+
+    onWrite(var, val, time) is called from the writer thread after every
+    successful write, e.g. to match the firmware's echo.
+    """
+    def __init__(self, write, interval=WRITE_INTERVAL, onWrite=None):
+        self.write = write
+        self.interval = interval
+        self.onWrite = onWrite
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.order = collections.deque()  # slots and FIFO entries in send order
+        self.pending = {}  # slot -> [val, enqueued at] or [steps, stop, enqueued at] for ges
+        self.thread = None
+        self.lastWrite = 0.0
+        self.writeTime = pipeline_stats.Histogram()
+        self.waitTime = pipeline_stats.Histogram()
+        self.counters = {'queued': 0, 'written': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+        self.maxDepth = 0
+
+    def put(self, var, val):
+        """Queue a command; never blocks on the port."""
+        now = time.time()
+        slot = slot_of(var, val)
+        with self.lock:
+            self.counters['queued'] += 1
+            entry = self.pending.get(slot) if slot else None
+            if slot is None:
+                fifo = sum(1 for item in self.order if isinstance(item, tuple))
+                if fifo >= FIFO_MAX:
+                    oldest = next(item for item in self.order if isinstance(item, tuple))
+                    self.order.remove(oldest)
+                    self.counters['dropped'] += 1
+                self.order.append((var, val, now))
+            elif var == 'ges':
+                step = GES_STEPS[val][1]
+                if entry is None:
+                    self.pending[slot] = [step, step == 0, now]
+                    self.order.append(slot)
+                elif step:
+                    steps = max(-GES_MAX_STEPS, min(GES_MAX_STEPS, entry[0] + step))
+                    # counts the writes saved: a step against a pending one
+                    # cancels both, a step past the clamp is lost
+                    if abs(steps) < abs(entry[0]):
+                        self.counters['coalesced'] += 2
+                    elif steps == entry[0]:
+                        self.counters['coalesced'] += 1
+                    entry[0] = steps
+                    if not steps and not entry[1]:
+                        # nothing left to send, not even a stop
+                        del self.pending[slot]
+                        self.order.remove(slot)
+                else:
+                    if entry[1]:
+                        self.counters['coalesced'] += 1
+                    entry[1] = True
+            elif entry is None:
+                self.pending[slot] = [val, now]
+                self.order.append(slot)
+            else:
+                self.counters['coalesced'] += 1
+                entry[0] = val
+            self.maxDepth = max(self.maxDepth, len(self.order))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_loop, daemon=True)
+                self.thread.start()
+            self.ready.notify()
+
+    def take(self):
+        """Next (var, val, enqueued at) to write; called with the lock held."""
+        item = self.order.popleft()
+        if isinstance(item, tuple):
+            return item
+        entry = self.pending[item]
+        var = item.split('.')[0]
+        if var != 'ges':
+            del self.pending[item]
+            return (var, entry[0], entry[1])
+        axis = item.split('.')[1]
+        steps, stop, enqueued = entry
+        if steps:
+            step = 1 if steps > 0 else -1
+            entry[0] -= step
+            val = GES_VALS[(axis, step)]
+        else:
+            entry[1] = False
+            val = GES_VALS[(axis, 0)]
+        if entry[0] or entry[1]:
+            self.order.append(item)
+        else:
+            del self.pending[item]
+        return ('ges', val, enqueued)
+
+    def write_loop(self):
+        while True:
+            with self.lock:
+                while not self.order:
+                    self.ready.wait()
+            # leave the firmware one serialCtrl() cycle per command; what
+            # arrives meanwhile still coalesces with the waiting commands
+            delay = self.lastWrite + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                if not self.order:
+                    # cancelled out while waiting
+                    continue
+                var, val, enqueued = self.take()
+            start = time.time()
+            try:
+                ok = self.write(json.dumps({'var': var, 'val': val}).encode())
+            except Exception as e:
+                print(f"Error writing to serial: {e}")
+                ok = False
+            done = time.time()
+            self.lastWrite = done
+            self.counters['written' if ok is not False else 'failed'] += 1
+            self.writeTime.record(done - start, done)
+            self.waitTime.record(start - enqueued, done)
+            if ok is not False and self.onWrite is not None:
+                try:
+                    self.onWrite(var, val, done)
+                except Exception as e:
+                    # the writer must outlive a failing callback, put() never restarts it
+                    print(f"Error after writing to serial: {e}")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['depth'] = len(self.order)
+        stats['max_depth'] = self.maxDepth
+        # write: time in ser.write(), wait: queued until the write started
+        for name, histogram in (('write_ms', self.writeTime), ('wait_ms', self.waitTime)):
+            percentiles, count = histogram.percentiles()
+            stats[name] = dict(('p%d' % point, ms) for point, ms in percentiles.items())
+        return stats
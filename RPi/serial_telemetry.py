@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# File name   : serial_telemetry.py
+# Description : Read what the ESP32 sends back: JSON telemetry and echo lines.
+#
+# The firmware writes `{"vol":7.9}` documents (jsonSend, no newline) between
+# println() text such as the move echoes "Forward" or "FBStop". The reader
+# thread takes whatever bytes the port has and splits them with bytes.find(),
+# so the Python work is per message, not per byte, and a message cut in two
+# by the read is completed by the next one. The latest values are published
+# by swapping one dict, readers never take a lock or touch the port.
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+import pipeline_stats
+from serial_channel import COMMANDS
+
+MAX_PENDING = 1024  # bytes without a complete message before they are thrown away
+WHITESPACE = b' \t\r\n\0'
+ECHO_TIMEOUT = 1.0  # s; a command not echoed by then counts as lost
+
+# what serialCtrl() prints for a command; ges, light and buzzer print nothing
+MOVE_ECHOES = {1: 'Forward', 2: 'TurnLeft', 3: 'FBStop', 4: 'TurnRight', 5: 'Backward', 6: 'LRStop'}
+COMMAND_NAMES = dict((command, name) for name, command in COMMANDS.items())
+
+
+class StreamParser(object):
+    """Splits a byte stream into JSON objects (dicts) and text lines (str)."""
+    def __init__(self):
+        self.buffer = b''
+        self.bad = 0  # JSON documents that did not parse, discarded garbage
+
+    def feed(self, data):
+        """Add bytes, return the messages completed by them."""
+        buffer = (self.buffer + data).lstrip(WHITESPACE)
+        messages = []
+        while buffer:
+            if buffer[:1] == b'{':
+                # the telemetry documents are flat and on one line, the
+                # first '}' ends one; a newline before it means it was cut
+                end = buffer.find(b'}')
+                newline = buffer.find(b'\n')
+                if newline >= 0 and (end < 0 or newline < end):
+                    self.bad += 1
+                    buffer = buffer[newline + 1:].lstrip(WHITESPACE)
+                    continue
+                if end < 0:
+                    break
+                try:
+                    messages.append(json.loads(buffer[:end + 1]))
+                except ValueError:
+                    self.bad += 1
+                buffer = buffer[end + 1:].lstrip(WHITESPACE)
+                continue
+            # text runs to the end of the line, or to a JSON document that
+            # follows it without a newline
+            end = buffer.find(b'\n')
+            start = buffer.find(b'{')
+            if start >= 0 and (end < 0 or start < end):
+                line, buffer = buffer[:start], buffer[start:]
+            elif end >= 0:
+                line, buffer = buffer[:end], buffer[end + 1:].lstrip(WHITESPACE)
+            else:
+                break
+            line = line.strip().decode('utf-8', 'replace')
+            if line:
+                messages.append(line)
+        if len(buffer) > MAX_PENDING:
+            # line noise or a lost '}', resynchronize on the next message
+            self.bad += 1
+            buffer = b''
+        self.buffer = buffer
+        return messages
+
+
+class TelemetryReader(object):
+    """Background reader of the serial port with a lock-free latest-value snapshot.
+
+    read() must return the bytes available on the port, waiting at most its
+    timeout for the first one (b'' if nothing came or there is no port).
+    """
+    def __init__(self, read, onLine=None):
+        self.read = read
+        self.onLine = onLine  # onLine(text, time) for every text line
+        self.parser = StreamParser()
+        self.thread = None
+        self.counters = {'bytes': 0, 'json': 0, 'lines': 0}
+        self.values = {}  # latest value and time of every JSON key
+        self.snapshot = {'values': {}, 'last_line': None, 'counters': dict(self.counters), 'bad': 0}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.read_loop, daemon=True)
+            self.thread.start()
+
+    def read_loop(self):
+        while True:
+            try:
+                data = self.read()
+            except Exception as e:
+                print(f"Error reading from serial: {e}")
+                time.sleep(1)
+                continue
+            if not data:
+                continue
+            try:
+                self.handle(data, time.time())
+            except Exception as e:
+                # a bad callback must not stop the port from being drained
+                print(f"Error handling serial data: {e}")
+
+    def handle(self, data, now):
+        self.counters['bytes'] += len(data)
+        lastLine = self.snapshot['last_line']
+        for message in self.parser.feed(data):
+            if isinstance(message, dict):
+                self.counters['json'] += 1
+                for key, value in message.items():
+                    self.values[key] = {'value': value, 'time': now}
+            else:
+                self.counters['lines'] += 1
+                lastLine = {'text': message, 'time': now}
+                if self.onLine is not None:
+                    self.onLine(message, now)
+        # a new dict instead of updating the published one, so a reader sees
+        # either the old or the new snapshot, never a half-updated one
+        self.snapshot = {
+            'values': dict(self.values),
+            'last_line': lastLine,
+            'counters': dict(self.counters),
+            'bad': self.parser.bad,
+        }
+
+    def voltage(self):
+        """Last battery voltage the firmware reported, None if it never did."""
+        vol = self.snapshot['values'].get('vol')
+        return vol['value'] if vol else None
+
+
+def echoes(var, val):
+    """The lines the firmware may answer a command with, () if it stays silent."""
+    if var == 'move' and val in MOVE_ECHOES:
+        return (MOVE_ECHOES[val],)
+    if var == 'funcMode':
+        # 1 toggles steady mode, everything else is echoed as the number
+        return ('Steady ON', 'Steady OFF') if val == 1 else (str(val),)
+    return ()
+
+
+class EchoTracker(object):
+    """Matches written commands with the lines the firmware echoes for them.
+
+    The firmware handles commands in order, so an echo belongs to the oldest
+    command in flight that expects it; the commands before that one were
+    lost (e.g. a corrupted document the firmware threw away), as is one
+    that is still unanswered after ECHO_TIMEOUT. The round trip runs from
+    the end of ser.write() to the echo line being read, per command type.
+    """
+    def __init__(self, timeout=ECHO_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.inFlight = collections.deque()  # (expected lines, name, sent at, futures)
+        self.waiting = {}  # (var, val) -> [(future, asked at)] of confirm() calls not written yet
+        self.latency = {}  # command name -> pipeline_stats.Histogram
+        self.counters = {'matched': 0, 'lost': 0, 'unmatched': 0}
+
+    def confirm(self, var, val):
+        """Future for the next write of this command: the round trip in seconds.
+
+        Fails with TimeoutError if the command is lost, resolves to None for
+        a command the firmware never echoes. A command that is coalesced
+        away in the queue is never written; its future fails as lost after
+        the timeout, too.
+        """
+        future = concurrent.futures.Future()
+        if not echoes(var, val):
+            future.set_result(None)
+            return future
+        now = time.time()
+        with self.lock:
+            lost = self.expire(now)
+            self.waiting.setdefault((var, val), []).append((future, now))
+        self.fail(lost)
+        return future
+
+    def sent(self, var, val, now):
+        expected = echoes(var, val)
+        if not expected:
+            return
+        name = COMMAND_NAMES.get((var, val), '%s:%s' % (var, val))
+        with self.lock:
+            futures = [future for future, askedAt in self.waiting.pop((var, val), [])]
+            self.inFlight.append((expected, name, now, futures))
+            lost = self.expire(now)
+        self.fail(lost)
+
+    def received(self, line, now):
+        matched = None
+        with self.lock:
+            lost = self.expire(now)
+            index = next((i for i, entry in enumerate(self.inFlight) if line in entry[0]), None)
+            if index is None:
+                # servo dumps, action names, a reset banner ...
+                self.counters['unmatched'] += 1
+            else:
+                for i in range(index):
+                    lost.append(self.inFlight.popleft())
+                    self.counters['lost'] += 1
+                expected, name, sentAt, futures = self.inFlight.popleft()
+                self.counters['matched'] += 1
+                histogram = self.latency.get(name)
+                if histogram is None:
+                    histogram = self.latency[name] = pipeline_stats.Histogram()
+                histogram.record(now - sentAt, now)
+                matched = (futures, now - sentAt)
+        self.fail(lost)
+        if matched is not None:
+            for future in matched[0]:
+                # a caller that gave up (asyncio.wait_for) cancelled it
+                if future.set_running_or_notify_cancel():
+                    future.set_result(matched[1])
+
+    def expire(self, now):
+        # with the lock held; returns the entries that timed out
+        lost = []
+        while self.inFlight and now - self.inFlight[0][2] > self.timeout:
+            lost.append(self.inFlight.popleft())
+            self.counters['lost'] += 1
+        # confirm() calls whose command was coalesced away or never written
+        for command, waiting in list(self.waiting.items()):
+            expired = [future for future, askedAt in waiting if now - askedAt > self.timeout]
+            if expired:
+                name = COMMAND_NAMES.get(command, '%s:%s' % command)
+                lost.append((None, name, None, expired))
+                waiting = [entry for entry in waiting if now - entry[1] <= self.timeout]
+                if waiting:
+                    self.waiting[command] = waiting
+                else:
+                    del self.waiting[command]
+        return lost
+
+    def fail(self, entries):
+        for expected, name, sentAt, futures in entries:
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(TimeoutError('no echo for %s' % name))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = len(self.inFlight)
+            histograms = list(self.latency.items())
+        latency = {}
+        for name, histogram in histograms:
+            percentiles, count = histogram.percentiles()
+            if count:
+                latency[name] = dict(('p%d' % point, ms) for point, ms in percentiles.items())
+                latency[name]['count'] = count
+        stats['latency_ms'] = latency
+        return stats
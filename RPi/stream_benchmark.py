@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# File name   : stream_benchmark.py
+# Description : Compare MJPEG endpoints: fps per viewer, server memory and CPU.
+#
+# Run on the robot (or against it) with the server already started, e.g.
+#   python3 stream_benchmark.py --pid $(pgrep -f webServer.py) \
+#       --url http://127.0.0.1:5000/video_feed --url http://127.0.0.1:5001/video_feed
+# The Flask endpoint is port 5000, the asyncio endpoint is port 5001.
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BOUNDARY = b'--frame'
+
+
+async def viewer(url, duration, counts, index):
+    """Read the multipart stream and count frame boundaries."""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, parts.netloc)).encode())
+    await writer.drain()
+    tail = b''
+    end = time.monotonic() + duration
+    try:
+        while time.monotonic() < end:
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), end - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data = tail + chunk
+            counts[index] += data.count(BOUNDARY)
+            tail = data[-(len(BOUNDARY) - 1):]
+    finally:
+        writer.close()
+
+
+async def run_level(url, viewers, duration, process):
+    counts = [0] * viewers
+    if process:
+        process.cpu_percent(None)
+        rss_before = process.memory_info().rss
+    tasks = [asyncio.ensure_future(viewer(url, duration, counts, i)) for i in range(viewers)]
+    # sample memory while the viewers are connected
+    await asyncio.sleep(duration / 2.0)
+    rss = process.memory_info().rss if process else 0
+    await asyncio.gather(*tasks, return_exceptions=True)
+    cpu = process.cpu_percent(None) if process else 0.0
+    fps = [c / float(duration) for c in counts]
+    result = {
+        'viewers': viewers,
+        'mean_fps': sum(fps) / len(fps),
+        'min_fps': min(fps),
+        'cpu': cpu,
+        'rss_mb': rss / 1e6,
+        'rss_per_viewer_kb': (rss - rss_before) / 1e3 / viewers if process else 0.0,
+    }
+    # give the server time to notice the disconnects
+    await asyncio.sleep(1.0)
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark MJPEG endpoints.')
+    parser.add_argument('--url', action='append', required=True, help='stream URL, may be repeated')
+    parser.add_argument('--pid', type=int, help='server process to sample memory/CPU from')
+    parser.add_argument('--viewers', default='1,5,10,20,40', help='viewer counts to try')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per level')
+    parser.add_argument('--target-fps', type=float, default=25.0)
+    args = parser.parse_args()
+
+    process = psutil.Process(args.pid) if (args.pid and psutil) else None
+    levels = [int(v) for v in args.viewers.split(',')]
+
+    for url in args.url:
+        print(url)
+        print('%8s %9s %8s %7s %9s %14s' % ('viewers', 'mean fps', 'min fps', 'cpu %', 'rss MB', 'KB/viewer'))
+        max_viewers = 0
+        for viewers in levels:
+            r = await run_level(url, viewers, args.duration, process)
+            print('%8d %9.1f %8.1f %7.1f %9.1f %14.1f' % (r['viewers'], r['mean_fps'], r['min_fps'],
+                                                        r['cpu'], r['rss_mb'], r['rss_per_viewer_kb']))
+            # small tolerance for frames split across the measurement edges
+            if r['min_fps'] >= args.target_fps * 0.95:
+                max_viewers = viewers
+        print('max viewers at %.0f fps: %d\n' % (args.target_fps, max_viewers))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# File name   : stream_flow.py
+# Description : Per-client flow control for the MJPEG stream.
+import collections
+import itertools
+import threading
+import time
+from stream_profile import SIZES, get_profile
+
+# frame rate caps, tried in this order when a client falls behind
+# (None = every frame the camera delivers)
+FPS_STEPS = (None, 15, 10, 5)
+
+SLOW_WRITE = 0.040  # s, smoothed write time above which the client is behind
+FAST_WRITE = 0.010  # s, smoothed write time below which it keeps up easily
+RECOVER_AFTER = 3.0  # s of fast writes before stepping back up
+SETTLE = 1.0  # s after any change before the next decision
+
+_lock = threading.Lock()
+_clients = {}
+_ids = itertools.count(1)
+
+
+def profile_ladder(profile):
+    """Return the profiles to fall back to, starting with the requested one."""
+    sizes = list(SIZES)
+    overlay = profile.overlay
+    steps = [profile, get_profile(profile.name, min(profile.quality, 60), overlay)]
+    for name in sizes[sizes.index(profile.name) + 1:]:
+        steps.append(get_profile(name, min(profile.quality, 60), overlay))
+        steps.append(get_profile(name, min(profile.quality, 40), overlay))
+    ladder = []
+    for step in steps:
+        if step not in ladder:
+            ladder.append(step)
+    return ladder
+
+
+class ClientFlow(object):
+    """Adapts frame rate and profile of one viewer to how fast it drains.
+
+    The time a frame write takes is the backpressure signal: a client that
+    keeps up writes into an empty socket buffer and returns immediately. When
+    the smoothed write time stays above SLOW_WRITE the frame rate is capped
+    first, then the profile steps down the ladder; after RECOVER_AFTER of fast
+    writes the steps are undone in reverse order.
+    """
+    def __init__(self, profile, remote=None):
+        self.id = next(_ids)
+        self.remote = remote
+        self.ladder = profile_ladder(profile)
+        self.fps_level = 0
+        self.profile_level = 0
+        self.write_avg = None
+        self.fast_since = None
+        self.changed = time.time()
+        self.last_sent = 0.0
+        self.last_seq = 0
+        self.sent = 0
+        self.dropped = 0
+        self.send_times = collections.deque(maxlen=50)
+
+    @property
+    def profile(self):
+        return self.ladder[self.profile_level]
+
+    @property
+    def max_fps(self):
+        return FPS_STEPS[self.fps_level]
+
+    def should_send(self, now):
+        """Whether a frame available now fits under the current frame rate cap."""
+        fps = self.max_fps
+        return fps is None or now - self.last_sent >= 1.0 / fps
+
+    def record_write(self, seconds, seq):
+        """Account one delivered frame and adapt to its write time."""
+        now = time.time()
+        if self.last_seq:
+            self.dropped += max(seq - self.last_seq - 1, 0)
+        self.last_seq = seq
+        self.last_sent = now - seconds
+        self.sent += 1
+        self.send_times.append(now)
+
+        if self.write_avg is None:
+            self.write_avg = seconds
+        else:
+            self.write_avg = self.write_avg * 0.8 + seconds * 0.2
+
+        if now - self.changed < SETTLE:
+            return
+        if self.write_avg > SLOW_WRITE:
+            self.fast_since = None
+            self.degrade(now)
+        elif self.write_avg < FAST_WRITE:
+            if self.fast_since is None:
+                self.fast_since = now
+            elif now - self.fast_since > RECOVER_AFTER:
+                self.fast_since = None
+                self.recover(now)
+        else:
+            self.fast_since = None
+
+    def degrade(self, now):
+        if self.fps_level < len(FPS_STEPS) - 1:
+            self.fps_level += 1
+        elif self.profile_level < len(self.ladder) - 1:
+            self.profile_level += 1
+        else:
+            return
+        self.changed = now
+
+    def recover(self, now):
+        if self.profile_level > 0:
+            self.profile_level -= 1
+        elif self.fps_level > 0:
+            self.fps_level -= 1
+        else:
+            return
+        self.changed = now
+
+    def fps(self):
+        if len(self.send_times) < 2 or time.time() - self.send_times[-1] > 2:
+            return 0.0
+        return (len(self.send_times) - 1) / (self.send_times[-1] - self.send_times[0])
+
+    def stats(self):
+        profile = self.profile
+        return {
+            'id': self.id,
+            'remote': self.remote,
+            'fps': round(self.fps(), 1),
+            'max_fps': self.max_fps,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'write_ms': round((self.write_avg or 0.0) * 1000.0, 1),
+            'profile': profile.name,
+            'quality': profile.quality,
+            'overlay': profile.overlay,
+        }
+
+
+def register(flow):
+    with _lock:
+        _clients[flow.id] = flow
+
+
+def unregister(flow):
+    with _lock:
+        _clients.pop(flow.id, None)
+
+
+def stats():
+    """Return per-client stream stats for all connected viewers."""
+    with _lock:
+        flows = list(_clients.values())
+    return [flow.stats() for flow in flows]
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# File name   : stream_profile.py
+# Description : Resolution/quality profiles for the MJPEG stream.
+import collections
+
+
+# overlay: whether the CV annotations are drawn into the frames; clients that
+# draw the detection feed themselves ask for the clean stream
+StreamProfile = collections.namedtuple('StreamProfile', ['name', 'width', 'height', 'quality', 'overlay'])
+
+# name: (width, height)
+SIZES = {
+    'full': (640, 480),
+    'half': (320, 240),
+    'thumbnail': (160, 120),
+}
+
+DEFAULT_SIZE = 'full'
+DEFAULT_QUALITY = 95  # same as cv2.IMWRITE_JPEG_QUALITY default
+
+# qualities are snapped to this step so that clients asking for 71, 72 and 73
+# share one encode instead of costing three
+QUALITY_STEP = 5
+QUALITY_MIN = 10
+QUALITY_MAX = 95
+
+
+def get_profile(name=None, quality=None, overlay=None):
+    """Return the StreamProfile for a size name, a JPEG quality and overlay flag.
+
+    overlay may be a bool or a query string value ('0', 'false', 'off' mean a
+    clean stream). Raises ValueError for an unknown size name or a
+    non-numeric quality.
+    """
+    if not name:
+        name = DEFAULT_SIZE
+    if name not in SIZES:
+        raise ValueError('unknown profile %r, expected one of %s' % (name, ', '.join(SIZES)))
+
+    if quality is None or quality == '':
+        quality = DEFAULT_QUALITY
+    quality = int(quality)
+    quality = int(round(quality / float(QUALITY_STEP))) * QUALITY_STEP
+    quality = max(QUALITY_MIN, min(QUALITY_MAX, quality))
+
+    if overlay is None or overlay == '':
+        overlay = True
+    elif isinstance(overlay, str):
+        overlay = overlay.lower() not in ('0', 'false', 'no', 'off')
+    else:
+        overlay = bool(overlay)
+
+    width, height = SIZES[name]
+    return StreamProfile(name, width, height, quality, overlay)
+
+
+DEFAULT_PROFILE = get_profile()
@@ -12,6 +12,8 @@ import info
 import asyncio
 import websockets
 import app
+import async_stream
+from stream_profile import get_profile
 
 # Globale Variable fÃ¼r die Flask-App und IP
 flask_app = None
@@ -51,8 +53,47 @@ async def check_permit(websocket):
     return True
 
 
+async def start_video(websocket, video_task, options):
+    # Startet (oder ersetzt) den binären Videokanal dieser Verbindung
+    options = options if isinstance(options, dict) else {}
+    profile = get_profile(options.get('profile'), options.get('quality'), options.get('overlay'))
+    stop_video(video_task)
+
+    async def send(frame):
+        await websocket.send(async_stream.video_message(frame))
+
+    task = asyncio.ensure_future(async_stream.deliver(send, profile, websocket.remote_address[0]))
+    return task, profile
+
+
+def stop_video(video_task):
+    if video_task is not None:
+        video_task.cancel()
+
+
+async def start_detections(websocket, feed_task):
+    # Startet den Feed der CV-Erkennungen dieser Verbindung, ein Datensatz
+    # pro ausgewertetem Bild: {"status": "ok", "title": "cvResult", "data": {...}}
+    stop_video(feed_task)
+
+    async def send(record):
+        await websocket.send('{"status":"ok","title":"cvResult","data":' + record.data + '}')
+
+    return asyncio.ensure_future(async_stream.deliver_records(send))
+
+
+# Befehle der Web-UI, die genau einen CV-Modus einschalten (oder alle aus)
+CV_SELECT = {
+    'findColor': 'findColor',
+    'motionGet': 'watchDog',
+    'stopCV': 'none',
+}
+
+
 async def recv_msg(websocket):
     # Hauptschleife zum Empfangen von Steuerbefehlen
+    video_task = None
+    feed_task = None
 
     try:
         while True:
@@ -77,26 +118,46 @@ async def recv_msg(websocket):
                 # Verarbeitet Befehle, die als einfacher String gesendet werden
                 if isinstance(data, str):
                     # Leitet fast alle String-Befehle direkt an die Roboter-Steuerung weiter
-                    if data not in ['get_info', 'scan']:
+                    if data not in ['get_info', 'scan', 'videoSubscribe', 'videoUnsubscribe',
+                                    'cvSubscribe', 'cvUnsubscribe']:
                         flask_app.commandInput(data)
 
                     if data == 'get_info':
                         response['title'] = 'get_info'
-                        response['data'] = [info.get_cpu_tempfunc(), info.get_cpu_use(), info.get_ram_info()]
+                        # the web UI reads the first three entries, the stream
+                        # stats are appended for other clients
+                        response['data'] = [info.get_cpu_tempfunc(), info.get_cpu_use(), info.get_ram_info(),
+                                            flask_app.streamInfo()]
 
-                    elif data == 'findColor':
-                        flask_app.modeselect('findColor')
+                    elif data in CV_SELECT:
+                        flask_app.modeselect(CV_SELECT[data])
 
                     elif data == 'scan':
                         radar_send = [[3,60],[10,70],[10,80],[10,90],[10,100],[10,110],[3,120]]
                         response['title'] = 'scanResult'
                         response['data'] = radar_send
 
-                    elif data == 'motionGet':
-                        flask_app.modeselect('watchDog')
+                    elif data == 'videoSubscribe':
+                        video_task, profile = await start_video(websocket, video_task, None)
+                        response['title'] = 'videoSubscribe'
+                        response['data'] = profile._asdict()
+
+                    elif data == 'videoUnsubscribe':
+                        stop_video(video_task)
+                        video_task = None
+                        response['title'] = 'videoUnsubscribe'
 
-                    elif data == 'stopCV':
-                        flask_app.modeselect('none')
+                    # Erkennungen als JSON statt eingezeichnet ins Video;
+                    # saubere Bilder gibt es mit {"overlay": false} im Profil
+                    elif data == 'cvSubscribe':
+                        feed_task = await start_detections(websocket, feed_task)
+                        response['title'] = 'cvSubscribe'
+                        response['data'] = app.Camera.modeSelect
+
+                    elif data == 'cvUnsubscribe':
+                        stop_video(feed_task)
+                        feed_task = None
+                        response['title'] = 'cvUnsubscribe'
 
                 # Verarbeitet Befehle, die als JSON-Objekt (dict) gesendet werden
                 elif isinstance(data, dict):
@@ -105,6 +166,20 @@ async def recv_msg(websocket):
                         if color and len(color) == 3:
                             flask_app.colorFindSet(color[0], color[1], color[2])
 
+                    # Mehrere CV-Modi gleichzeitig, z.B.
+                    # {"title": "cvModes", "data": ["watchDog", "faceDetection"]}
+                    elif data.get('title') == "cvModes":
+                        flask_app.modeselect(data.get('data') or 'none')
+                        response['title'] = 'cvModes'
+                        response['data'] = app.Camera.modeSelect
+
+                    # Video als Binärnachrichten auf dieser Verbindung, z.B.
+                    # {"title": "videoSubscribe", "data": {"profile": "half", "quality": 60, "overlay": false}}
+                    elif data.get('title') == "videoSubscribe":
+                        video_task, profile = await start_video(websocket, video_task, data.get('data'))
+                        response['title'] = 'videoSubscribe'
+                        response['data'] = profile._asdict()
+
                 response_json = json.dumps(response)
                 await websocket.send(response_json)
 
@@ -126,6 +201,8 @@ async def recv_msg(websocket):
     except Exception as e:
         print(f"FATALER FEHLER in recv_msg: {e}")
     finally:
+        stop_video(video_task)
+        stop_video(feed_task)
         print(f"INFO: recv_msg beendet für {websocket.remote_address}")
 
 
@@ -150,6 +227,12 @@ async def main_logic(websocket, path=None):
 async def main_async_server():
     # 'async with' startet den Server und stellt sicher, dass er sauber beendet wird
 
+    # MJPEG-Stream ohne Thread pro Zuschauer, läuft in derselben Event-Loop
+    try:
+        await async_stream.start_server("0.0.0.0", async_stream.MJPEG_PORT)
+    except Exception as e:
+        print(f"FEHLER beim Starten des asyncio MJPEG-Servers: {e}")
+
     try:
         async with websockets.serve(main_logic, "0.0.0.0", 8888):
             print("INFO: WebSocket-Server erfolgreich auf Port 8888 gestartet.")